@@ -0,0 +1,158 @@
+"""
+webhook 1 件あたりの DB 処理（状態の取得・更新、ログの保存）のオーバーヘッドを計測する
+
+    rye run python -m scripts.bench_db [--users 50] [--messages 20]
+
+--users 人のユーザーが並行して --messages 件ずつ質問を送った場合を想定し、
+関数ごとに接続を作り直す従来の方式（before）と、src.utils の接続を使い回す方式（after）の
+スループットと 1 件あたりの時間を比較する。DB は一時ディレクトリに作成する。
+"""
+
+import argparse
+import datetime
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+tmp_dir = tempfile.mkdtemp()
+os.environ["DB_PATH"] = os.path.join(tmp_dir, "after.db")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+
+from src import utils  # noqa: E402
+
+BEFORE_DB_PATH = os.path.join(tmp_dir, "before.db")
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+
+def legacy_get_user_state(user_id):
+    conn = sqlite3.connect(BEFORE_DB_PATH, timeout=30)
+    row = conn.execute(
+        "SELECT step, research_id, last_question FROM user_state WHERE user_id=?",
+        (user_id,),
+    ).fetchone()
+    conn.close()
+    return row if row else (0, None, None)
+
+
+def legacy_update_user_state(user_id, step, registration_time):
+    conn = sqlite3.connect(BEFORE_DB_PATH, timeout=30)
+    if registration_time is not None:
+        conn.execute(
+            "INSERT OR REPLACE INTO user_state (user_id, step, registration_time) VALUES (?, ?, ?)",
+            (user_id, step, registration_time),
+        )
+        conn.commit()
+        conn.close()
+        return
+    conn.execute(
+        "SELECT research_id, registration_time, reminder_3days, reminder_7days, reminder_14days, reminder_21days, before_the_last_day, after_use_ends FROM user_state WHERE user_id=?",
+        (user_id,),
+    ).fetchone()
+    conn.execute("SELECT 1 FROM user_state WHERE user_id=?", (user_id,)).fetchone()
+    conn.execute(
+        "UPDATE user_state SET step=?, last_question=? WHERE user_id=?",
+        (step, None, user_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+def legacy_save_message_to_db(user_id, message_id, user_message, timestamp):
+    conn = sqlite3.connect(BEFORE_DB_PATH, timeout=30)
+    conn.execute(
+        """
+        INSERT INTO chat_logs (user_id, message_id, user_message, response_id, reply_id, timestamp, version)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (user_id, message_id, user_message, "0", "", timestamp, "bench"),
+    )
+    conn.commit()
+    conn.close()
+
+
+def setup_before_db():
+    # 従来どおり rollback journal（WAL なし）の DB を作る
+    conn = sqlite3.connect(BEFORE_DB_PATH)
+    for table in ("chat_logs", "user_state"):
+        (sql,) = utils.get_connection().execute(
+            "SELECT sql FROM sqlite_master WHERE name=?", (table,)
+        ).fetchone()
+        conn.execute(sql)
+    conn.commit()
+    conn.close()
+
+
+def run(label, get_state, update_state, save_message, users, messages):
+    registered = datetime.datetime.now(JST)
+    for u in range(users):
+        update_state(f"U{u}", 3, registered)
+
+    def user_session(u):
+        latencies = []
+        for m in range(messages):
+            start = time.perf_counter()
+            get_state(f"U{u}")
+            save_message(f"U{u}", f"{u}-{m}", "質問", datetime.datetime.now(JST))
+            update_state(f"U{u}", 3, None)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        latencies = sorted(
+            latency
+            for session in executor.map(user_session, range(users))
+            for latency in session
+        )
+    elapsed = time.perf_counter() - start
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    print(
+        f"{label:6s} {len(latencies) / elapsed:9.1f} msg/s  "
+        f"p50 {percentile(0.5):7.2f} ms  p95 {percentile(0.95):7.2f} ms  "
+        f"p99 {percentile(0.99):7.2f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20)
+    args = parser.parse_args()
+
+    setup_before_db()
+
+    def save_message(user_id, message_id, user_message, timestamp):
+        utils.save_message_to_db(
+            user_id, message_id, user_message, "0", "", timestamp, "bench"
+        )
+
+    def update_state(user_id, step, registration_time):
+        utils.update_user_state(user_id, step, None, None, registration_time)
+
+    print(f"users={args.users} messages/user={args.messages}")
+    run(
+        "before",
+        legacy_get_user_state,
+        legacy_update_user_state,
+        legacy_save_message_to_db,
+        args.users,
+        args.messages,
+    )
+    run(
+        "after",
+        utils.get_user_state,
+        update_state,
+        save_message,
+        args.users,
+        args.messages,
+    )
+    utils.close_connections()
+
+
+if __name__ == "__main__":
+    main()
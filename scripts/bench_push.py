@@ -0,0 +1,72 @@
+"""
+リマインダーの一斉送信のスループットを、ローカルのモック LINE サーバーに対して計測する
+
+    rye run python -m scripts.bench_push [--users 10000] [--latency-ms 20] [--error-rate 0.01]
+
+一時 DB に --users 人を 3 日前の登録で作成し、3日後リマインダーを check_reminders_async で送る。
+送信後にもう一度実行し、二重送信がないこと（0 件）も確認する。
+"""
+
+import argparse
+import asyncio
+import datetime
+import os
+import tempfile
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--users", type=int, default=10000)
+parser.add_argument("--latency-ms", type=float, default=20.0)
+parser.add_argument("--error-rate", type=float, default=0.0)
+parser.add_argument("--concurrency", type=int, default=None)
+parser.add_argument("--rate-limit", type=float, default=None)
+parser.add_argument("--port", type=int, default=3401)
+args = parser.parse_args()
+
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+os.environ["LINE_API_BASE_URL"] = f"http://127.0.0.1:{args.port}"
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+
+import httpx  # noqa: E402
+
+from scripts.mock_line_server import start_server  # noqa: E402
+from src.push_dispatcher import PushDispatcher  # noqa: E402
+from src.send_reminders import check_reminders_async  # noqa: E402
+from src.utils import close_http_client, update_user_states  # noqa: E402
+
+
+async def main():
+    jst = datetime.timezone(datetime.timedelta(hours=9))
+    registered = datetime.datetime.now(jst) - datetime.timedelta(days=3, minutes=1)
+    update_user_states(
+        [(f"U{i:08d}", 3, f"R{i}", None, registered) for i in range(args.users)]
+    )
+
+    server = start_server(args.port, args.latency_ms, args.error_rate)
+    options = {}
+    if args.concurrency is not None:
+        options["concurrency"] = args.concurrency
+    if args.rate_limit is not None:
+        options["rate_limit"] = args.rate_limit
+
+    dispatcher = PushDispatcher(**options)
+    start = time.perf_counter()
+    await check_reminders_async(dispatcher)
+    elapsed = time.perf_counter() - start
+    await check_reminders_async(dispatcher)
+    await close_http_client()
+
+    async with httpx.AsyncClient() as client:
+        stats = (await client.get(f"{os.environ['LINE_API_BASE_URL']}/_stats")).json()
+    server.terminate()
+
+    print(f"users:      {args.users}")
+    print(f"elapsed:    {elapsed:.2f} s ({args.users / elapsed:.0f} users/s)")
+    print(f"requests:   {stats['requests']} (retries {dispatcher.retries})")
+    print(f"errors:     {stats['errors']}")
+    print(f"recipients: {stats['recipients']} (duplicates {stats['duplicates']})")
+    print(f"failures:   {dispatcher.failures}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,119 @@
+"""
+ベクトルインデックス（全件検索 / IVF）の速度と精度を比較する
+
+    rye run python -m scripts.bench_vector_index [--size 200000] [--nprobe 4 8 16]
+    rye run python -m scripts.bench_vector_index --index-dir ./data/outputs/faq_index
+
+--index-dir を指定すると保存済みの FAQ インデックスのベクトルを使い、
+指定しなければ --size 件のクラスタ状の乱数ベクトルを使う。
+クエリはコーパスのベクトルにノイズを加えたもの（言い換えの代わり）で、
+recall@1 は全件検索の top-1 と一致した割合。
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from src.embedding_index import META_FILE_NAME
+from src.vector_index import BruteForceIndex, IvfIndex
+
+
+def normalize(vectors):
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def synthetic_vectors(size, dim, rng):
+    # 文の埋め込みに近づけるため、話題（クラスタ）ごとにまとまったベクトルにする
+    centers = rng.standard_normal((max(1, size // 50), dim)).astype(np.float32)
+    assign = rng.integers(0, len(centers), size)
+    vectors = centers[assign] + 0.6 * rng.standard_normal((size, dim)).astype(np.float32)
+    return normalize(vectors)
+
+
+def load_index_vectors(index_dir):
+    with open(os.path.join(index_dir, META_FILE_NAME), encoding="utf-8") as f:
+        meta = json.load(f)
+    vectors = np.load(os.path.join(index_dir, meta["embeddings_file"]))
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def measure(index, queries, batch_size):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query[None, :], k=1)
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    for i in range(0, len(queries), batch_size):
+        index.search(queries[i : i + batch_size], k=1)
+    throughput = len(queries) / (time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000
+    return np.percentile(latencies, 50), np.percentile(latencies, 99), throughput
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index-dir", default=None)
+    parser.add_argument("--size", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--noise", type=float, default=0.05)
+    parser.add_argument("--nlist", type=int, default=0)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16, 32])
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    if args.index_dir:
+        vectors = load_index_vectors(args.index_dir)
+    else:
+        vectors = synthetic_vectors(args.size, args.dim, rng)
+    picked = rng.choice(len(vectors), args.queries)
+    queries = normalize(
+        vectors[picked]
+        + args.noise * rng.standard_normal((args.queries, vectors.shape[1])).astype(np.float32)
+    )
+    print(f"vectors: {vectors.shape}, queries: {len(queries)}")
+
+    brute = BruteForceIndex(vectors)
+    expected, _ = brute.search(queries, k=1)
+    p50, p99, qps = measure(brute, queries, args.batch_size)
+    print(
+        f"brute            recall@1 1.000  p50 {p50:7.2f} ms  p99 {p99:7.2f} ms  "
+        f"batch {qps:8.0f} q/s"
+    )
+
+    start = time.perf_counter()
+    ivf = IvfIndex(vectors, nlist=args.nlist, seed=args.seed)
+    print(f"ivf build: {time.perf_counter() - start:.1f} s (nlist {ivf.nlist})")
+    for nprobe in args.nprobe:
+        ivf.nprobe = nprobe
+        found, _ = ivf.search(queries, k=1)
+        recall = float(np.mean(found[:, 0] == expected[:, 0]))
+        p50, p99, qps = measure(ivf, queries, args.batch_size)
+        print(
+            f"ivf nprobe {nprobe:<5} recall@1 {recall:.3f}  p50 {p50:7.2f} ms  "
+            f"p99 {p99:7.2f} ms  batch {qps:8.0f} q/s"
+        )
+
+    # 作り直さずに 1,000 件を削除・追加する時間
+    changed = rng.choice(len(vectors), min(1000, len(vectors)), replace=False)
+    for name, index in (("brute", brute), ("ivf", ivf)):
+        start = time.perf_counter()
+        index.remove(changed)
+        removed = time.perf_counter() - start
+        start = time.perf_counter()
+        index.add(changed, vectors[changed])
+        added = time.perf_counter() - start
+        print(
+            f"{name:<6} remove {len(changed)}: {removed * 1000:.1f} ms, "
+            f"add {len(changed)}: {added * 1000:.1f} ms, size {len(index)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
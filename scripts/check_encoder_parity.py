@@ -0,0 +1,58 @@
+"""
+PyTorch 版と ONNX 版のエンコーダで FAQ の検索結果（top-1）が一致するかを確認する
+
+    rye run python -m scripts.check_encoder_parity [--model-file model.int8.onnx] [--min-agreement 0.95]
+
+一致率が --min-agreement を下回った場合は終了コード 1 を返す。
+"""
+
+import argparse
+import json
+import sys
+
+from src.encoders import (
+    ONNX_MODEL_DIR,
+    ONNX_MODEL_FILE,
+    OnnxEncoder,
+    SentenceTransformerEncoder,
+    check_parity,
+)
+from src.faq_store import load_faq_entries
+from src.find_answer import faq_data_path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--faq", default=faq_data_path)
+    parser.add_argument("--model-dir", default=ONNX_MODEL_DIR)
+    parser.add_argument("--model-file", default=ONNX_MODEL_FILE)
+    parser.add_argument("--min-agreement", type=float, default=0.95)
+    args = parser.parse_args()
+
+    # サービングと同じ読み込み方（空欄だけを空文字列として扱う）で、同じ質問文を比べる
+    entries = load_faq_entries(args.faq)
+    questions = [entry.question for entry in entries]
+    # クイックリプライで送られてくる文字列を、FAQ にない入力の例として使う
+    queries = [
+        text
+        for entry in entries
+        for text in entry.option_question.split("\t")
+        if text
+    ]
+
+    result = check_parity(
+        SentenceTransformerEncoder(),
+        OnnxEncoder(model_dir=args.model_dir, model_file=args.model_file),
+        questions,
+        queries,
+    )
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    agreement = min(result["question_agreement"], result.get("query_agreement", 1.0))
+    if agreement < args.min_agreement:
+        print(f"top-1 agreement {agreement:.3f} < {args.min_agreement}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+FAQ 検索の精度と速度を、記録済みの質問（chat_logs）やラベル付きの質問で比較する
+
+    rye run python -m scripts.evaluate_retrieval --config torch:brute --config onnx:brute
+    rye run python -m scripts.evaluate_retrieval --labels labeled.csv --config onnx:ivf --thresholds 0.4 0.5 0.6
+    rye run python -m scripts.evaluate_retrieval --config onnx:brute --config onnx:brute:fusion --config onnx:brute:candidates
+
+--config は「エンコーダ:インデックス[:ハイブリッド]」（エンコーダは torch / onnx、インデックスは brute / ivf、
+ハイブリッドは FAQ_HYBRID と同じ off / fusion / candidates）で、
+最初の設定を基準にして、ほかの設定の top-1 の一致率を求める。
+質問は --db の chat_logs の user_message（response_id が行番号のもの）を使い、
+記録されている response_id（本番で返した行）を正解の代わりにする。
+FAQ の CSV を更新すると行番号が変わるので、比較には同じ CSV の期間のログを使うこと。
+--labels を指定すると、query,expected の CSV（expected は FAQ の行番号または Question の文字列）を使う。
+
+出力（JSON）
+- top1 / topk: 正解（ラベルまたは記録）が 1 位 / 上位 k 件に入った割合
+  （ハイブリッドは 1 件だけを返すので、topk は top1 と同じ値になる）
+- agreement_top1: 基準の設定と 1 位が一致した割合
+- scores: 1 位のスコアの分布
+- thresholds: スコアがしきい値以上の質問の割合（answered）と、その中での正解率
+- encode_qps / search_qps: バッチでの encode・検索の速度
+"""
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from src.encoders import ONNX_MODEL_DIR, ONNX_MODEL_FILE, create_encoder
+from src.find_answer import FAQ_DATA_PATH, FaqService
+
+
+def load_logged_queries(db_path, limit, unique):
+    """chat_logs から (質問, 返した行番号) を読み込む"""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute(
+            "SELECT user_message, response_id FROM chat_logs ORDER BY id"
+        ).fetchall()
+    finally:
+        conn.close()
+    queries = []
+    seen = set()
+    for user_message, response_id in rows:
+        # 行番号でないもの（定型文で返したものなど）は除く
+        if not user_message or not response_id.lstrip("-").isdigit():
+            continue
+        if int(response_id) < 0:
+            continue
+        if unique:
+            if user_message in seen:
+                continue
+            seen.add(user_message)
+        queries.append((user_message, int(response_id)))
+    return queries[-limit:] if limit else queries
+
+
+def load_labeled_queries(path, questions):
+    row_by_question = {}
+    for i, question in enumerate(questions):
+        row_by_question.setdefault(question, i)
+    queries = []
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            expected = row["expected"]
+            if expected.isdigit():
+                queries.append((row["query"], int(expected)))
+            elif expected in row_by_question:
+                queries.append((row["query"], row_by_question[expected]))
+            else:
+                print(f"skip: expected question not found: {expected}")
+    return queries
+
+
+def create_service(config, args):
+    backend, index, hybrid = (config.split(":") + ["off"])[:3]
+    if backend == "onnx":
+        encoder = create_encoder(
+            "onnx", model_dir=args.onnx_model_dir, model_file=args.onnx_model_file
+        )
+    else:
+        encoder = create_encoder(backend)
+    encoder.load()
+    return FaqService(
+        args.faq,
+        # 本番のインデックスを書き換えないよう、エンコーダごとに別の場所に作る
+        index_dir=os.path.join(args.index_dir, backend),
+        encoder=encoder,
+        vector_index=index,
+        ivf_nprobe=args.nprobe,
+        cache_size=0,
+        hybrid=hybrid,
+        hybrid_candidates=args.hybrid_candidates,
+    )
+
+
+def evaluate(service, texts, k, batch_size):
+    """バッチで encode・検索し、上位 k 件の行番号とスコア、各処理の時間を返す"""
+    # 1 回目の呼び出しの初期化の時間を含めないよう、先に 1 バッチ流しておく
+    service.search(service.encode(texts[:batch_size]), k)
+
+    encode_seconds = 0.0
+    search_seconds = 0.0
+    indices = []
+    scores = []
+    for i in range(0, len(texts), batch_size):
+        start = time.perf_counter()
+        embeddings = service.encode(texts[i : i + batch_size])
+        encode_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        if service.lexical is None:
+            top_indices, top_scores = service.search(embeddings, k)
+        else:
+            results = [
+                service.hybrid_search(text, embedding)
+                for text, embedding in zip(texts[i : i + batch_size], embeddings)
+            ]
+            top_indices = np.array([[index] for index, _ in results])
+            top_scores = np.array([[score] for _, score in results])
+        search_seconds += time.perf_counter() - start
+        indices.append(top_indices)
+        scores.append(top_scores)
+    return np.concatenate(indices), np.concatenate(scores), encode_seconds, search_seconds
+
+
+def score_summary(top1_scores):
+    percentiles = {
+        f"p{q}": round(float(np.percentile(top1_scores, q)), 4)
+        for q in (1, 5, 25, 50, 75, 95)
+    }
+    return {**percentiles, "mean": round(float(np.mean(top1_scores)), 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", action="append", default=None)
+    parser.add_argument("--faq", default=FAQ_DATA_PATH)
+    parser.add_argument("--db", default=os.getenv("DB_PATH", "./data/outputs/chatbot.db"))
+    parser.add_argument("--labels", default=None)
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--unique", action="store_true")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--thresholds", type=float, nargs="*", default=[0.3, 0.4, 0.5, 0.6, 0.7])
+    parser.add_argument("--index-dir", default="./data/outputs/eval_index")
+    parser.add_argument("--onnx-model-dir", default=ONNX_MODEL_DIR)
+    parser.add_argument("--onnx-model-file", default=ONNX_MODEL_FILE)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--hybrid-candidates", type=int, default=50)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+    configs = args.config or ["torch:brute"]
+
+    results = {}
+    reference = None
+    queries = None
+    for config in configs:
+        service = create_service(config, args)
+        if queries is None:
+            if args.labels:
+                queries = load_labeled_queries(args.labels, service.questions)
+            else:
+                queries = load_logged_queries(args.db, args.limit, args.unique)
+            if not queries:
+                raise SystemExit("no queries to evaluate")
+            texts = [text for text, _ in queries]
+            expected = np.array([row for _, row in queries])
+            print(f"queries: {len(queries)}")
+
+        indices, scores, encode_seconds, search_seconds = evaluate(
+            service, texts, args.k, args.batch_size
+        )
+        top1 = indices[:, 0]
+        correct = top1 == expected
+        result = {
+            "top1": round(float(np.mean(correct)), 4),
+            f"top{args.k}": round(float(np.mean((indices == expected[:, None]).any(axis=1))), 4),
+            "scores": score_summary(scores[:, 0]),
+            "thresholds": {},
+            "encode_qps": round(len(texts) / encode_seconds, 1),
+            "search_qps": round(len(texts) / search_seconds, 1),
+        }
+        if reference is None:
+            reference = top1
+        else:
+            result["agreement_top1"] = round(float(np.mean(top1 == reference)), 4)
+        for threshold in args.thresholds:
+            answered = scores[:, 0] >= threshold
+            result["thresholds"][str(threshold)] = {
+                "answered": round(float(np.mean(answered)), 4),
+                "top1_when_answered": (
+                    round(float(np.mean(correct[answered])), 4) if answered.any() else None
+                ),
+            }
+        results[config] = result
+        service.executor.shutdown(wait=False)
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+"""
+埋め込みモデルを ONNX に書き出し、int8 の動的量子化を行う
+
+    rye run python -m scripts.export_onnx [出力先ディレクトリ]
+
+書き出したら、サービング側で以下を設定する
+    FAQ_ENCODER_BACKEND=onnx
+    FAQ_ONNX_MODEL_DIR=<出力先ディレクトリ>
+"""
+
+import sys
+
+from src.encoders import ONNX_MODEL_DIR, export_onnx
+
+
+if __name__ == "__main__":
+    output_dir = sys.argv[1] if len(sys.argv) > 1 else ONNX_MODEL_DIR
+    export_onnx(output_dir)
+    print(f"exported: {output_dir}")
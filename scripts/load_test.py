@@ -0,0 +1,322 @@
+"""
+webhook の受信から LINE への返信までを計測する負荷試験
+
+    rye run python -m scripts.load_test [--users 50] [--questions 10] [--output result.json]
+    rye run python -m scripts.load_test --app-url http://127.0.0.1:3300 --mock-url http://127.0.0.1:3400
+
+モック LINE サーバー（scripts/mock_line_server.py）と src.rule:app を別プロセスで起動し、
+署名付きの webhook（友だち追加 → 研究 ID の登録 → 同意 → 質問・クイックリプライ）を送る。
+各ユーザーは返信がモックに届いてから次のイベントを送り、ユーザー同士は並行して動く。
+--app-url / --mock-url を指定すると、起動済みのアプリとモックに対して実行する
+（その場合アプリは LINE_API_BASE_URL をモックに向け、LINE_CHANNEL_SECRET を --secret と同じにしておく）。
+
+シナリオは --seed と FAQ の CSV から決まるので、同じ引数なら毎回同じイベントが送られる。
+--save-corpus で書き出した JSONL を --corpus に渡すと、そのまま再生できる。
+
+計測する値
+- ack: webhook を送ってから 200 が返るまで（署名の検証・キューへの投入）
+- e2e: webhook を送ってから返信がモックに届くまで（イベントの種類別にも集計）
+- app: アプリの GET /stats の差分（イベントキューの待ち時間・キャッシュのヒット数など）と、
+  GET /metrics から求めた処理段階ごとの平均時間（ユーザー状態の取得・encode・返信など）
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+import numpy as np
+
+from scripts.mock_line_server import start_server
+from src.faq_store import load_faq_entries
+from src.find_answer import FAQ_DATA_PATH
+
+
+def build_corpus(faq_path, users, questions, seed):
+    """ユーザーごとのイベント列を作る。イベントは (種類, テキスト)"""
+    rng = random.Random(seed)
+    entries = load_faq_entries(faq_path)
+    free_texts = [entry.question for entry in entries if entry.question]
+    taps = sorted(
+        {
+            text
+            for entry in entries
+            for text in entry.option_question.split("\t")
+            if text
+        }
+    )
+
+    corpus = []
+    for i in range(users):
+        events = [
+            ("follow", None),
+            ("registration", f"R{seed:03d}{i:05d}"),
+            ("consent", "はい"),
+        ]
+        for _ in range(questions):
+            if taps and rng.random() < 0.3:
+                events.append(("quick_reply", rng.choice(taps)))
+            else:
+                text = rng.choice(free_texts)
+                # 言い換えの代わりに、語尾を落とした質問も混ぜる
+                if rng.random() < 0.5:
+                    text = text.rstrip("？?。")
+                events.append(("question", text))
+        corpus.append({"user": f"Uload{seed:03d}{i:05d}", "events": events})
+    return corpus
+
+
+def read_corpus(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_corpus(path, corpus):
+    with open(path, "w", encoding="utf-8") as f:
+        for user in corpus:
+            f.write(json.dumps(user, ensure_ascii=False) + "\n")
+
+
+def webhook_body(user_id, kind, text, reply_token):
+    event = {
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": uuid.uuid4().hex,
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": reply_token,
+    }
+    if kind == "follow":
+        event["type"] = "follow"
+    else:
+        event["type"] = "message"
+        event["message"] = {
+            "type": "text",
+            "id": uuid.uuid4().hex[:16],
+            "text": text,
+            "quoteToken": uuid.uuid4().hex,
+        }
+    return json.dumps({"destination": "Uload", "events": [event]}, ensure_ascii=False)
+
+
+def sign(secret, body):
+    digest = hmac.new(secret.encode(), body.encode(), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+
+async def run_user(client, args, user, results):
+    for kind, text in user["events"]:
+        reply_token = uuid.uuid4().hex
+        body = webhook_body(user["user"], kind, text, reply_token)
+        headers = {
+            "Content-Type": "application/json",
+            "X-Line-Signature": sign(args.secret, body),
+        }
+        sent_at = time.time()
+        response = await client.post(f"{args.app_url}/callback", content=body, headers=headers)
+        ack = time.time() - sent_at
+        if response.status_code != 200:
+            results.append((kind, response.status_code, ack, None))
+            continue
+        reply = await client.get(
+            f"{args.mock_url}/_replies/{reply_token}",
+            params={"timeout": args.reply_timeout},
+            timeout=args.reply_timeout + 5,
+        )
+        received_at = reply.json()["received_at"]
+        e2e = received_at - sent_at if received_at is not None else None
+        results.append((kind, response.status_code, ack, e2e))
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.array(values) * 1000
+    return {
+        "count": len(values),
+        "p50_ms": round(float(np.percentile(values, 50)), 2),
+        "p95_ms": round(float(np.percentile(values, 95)), 2),
+        "p99_ms": round(float(np.percentile(values, 99)), 2),
+        "max_ms": round(float(values.max()), 2),
+    }
+
+
+def stage_totals(metrics_text):
+    """/metrics の chatbot_stage_seconds から、処理段階ごとの (合計秒, 件数) を取り出す"""
+    totals = {}
+    for line in metrics_text.splitlines():
+        for suffix, position in (("_sum", 0), ("_count", 1)):
+            prefix = f"chatbot_stage_seconds{suffix}{{stage=\""
+            if line.startswith(prefix):
+                name, value = line[len(prefix) :].split("\"} ")
+                totals.setdefault(name, [0.0, 0])[position] = float(value)
+    return totals
+
+
+def stage_breakdown(before, after):
+    # 計測中に増えた分だけを、処理段階ごとの平均（ミリ秒）と件数にする
+    breakdown = {}
+    for name, (total, count) in sorted(after.items()):
+        base_total, base_count = before.get(name, (0.0, 0))
+        if count > base_count:
+            breakdown[name] = {
+                "count": int(count - base_count),
+                "avg_ms": round((total - base_total) / (count - base_count) * 1000, 3),
+            }
+    return breakdown
+
+
+def start_app(args, tmp_dir):
+    env = dict(os.environ)
+    env.update(
+        {
+            "DB_PATH": os.path.join(tmp_dir, "load_test.db"),
+            "SCHEDULER_LOCK_PATH": os.path.join(tmp_dir, "scheduler.lock"),
+            "LINE_API_BASE_URL": args.mock_url,
+            "LINE_CHANNEL_SECRET": args.secret,
+            "LINE_CHANNEL_ACCESS_TOKEN": env.get("LINE_CHANNEL_ACCESS_TOKEN", "load-test"),
+            "WEB_CONCURRENCY": str(args.workers),
+        }
+    )
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "src.rule:app",
+            "--port",
+            str(args.app_port),
+            "--workers",
+            str(args.workers),
+            "--log-level",
+            "warning",
+        ],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def wait_ready(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(f"{url}/ready").status_code == 200:
+                return True
+        except httpx.TransportError:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    if args.corpus:
+        corpus = read_corpus(args.corpus)
+    else:
+        corpus = build_corpus(args.faq, args.users, args.questions, args.seed)
+    if args.save_corpus:
+        write_corpus(args.save_corpus, corpus)
+
+    async with httpx.AsyncClient(
+        timeout=30, limits=httpx.Limits(max_connections=None)
+    ) as client:
+        app_stats_before = (await client.get(f"{args.app_url}/stats")).json()
+        stages_before = stage_totals((await client.get(f"{args.app_url}/metrics")).text)
+        await client.post(f"{args.mock_url}/_reset")
+
+        results = []
+        start = time.perf_counter()
+        await asyncio.gather(*[run_user(client, args, user, results) for user in corpus])
+        elapsed = time.perf_counter() - start
+
+        app_stats = (await client.get(f"{args.app_url}/stats")).json()
+        stages = stage_totals((await client.get(f"{args.app_url}/metrics")).text)
+        mock_stats = (await client.get(f"{args.mock_url}/_stats")).json()
+
+    by_kind = {}
+    for kind, _, _, e2e in results:
+        if e2e is not None:
+            by_kind.setdefault(kind, []).append(e2e)
+    events = app_stats["events"]
+    processed = events["processed"] - app_stats_before["events"]["processed"]
+    summary = {
+        "revision": git_revision(),
+        "users": len(corpus),
+        "events": len(results),
+        "elapsed_s": round(elapsed, 3),
+        "qps": round(len(results) / elapsed, 1),
+        "non_200": sum(1 for _, status, _, _ in results if status != 200),
+        "reply_timeouts": sum(1 for _, status, _, e2e in results if status == 200 and e2e is None),
+        "ack": percentiles([ack for _, _, ack, _ in results]),
+        "e2e": percentiles([e2e for _, _, _, e2e in results if e2e is not None]),
+        "e2e_by_kind": {kind: percentiles(values) for kind, values in sorted(by_kind.items())},
+        "app": {
+            # 複数ワーカーの場合は /stats に答えたワーカーの値
+            "events_processed": processed,
+            "events_failed": events["failed"] - app_stats_before["events"]["failed"],
+            "queue_lag_max_ms": round(events["lag_max"] * 1000, 2),
+            "user_state_cache": app_stats.get("user_state_cache"),
+            # 処理段階ごとの平均時間（METRICS_ENABLED=0 の場合は空）
+            "stages": stage_breakdown(stages_before, stages),
+        },
+        "line_api_requests": mock_stats["requests"],
+    }
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--questions", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--faq", default=FAQ_DATA_PATH)
+    parser.add_argument("--corpus", default=None)
+    parser.add_argument("--save-corpus", default=None)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--app-url", default=None)
+    parser.add_argument("--app-port", type=int, default=3410)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--mock-url", default=None)
+    parser.add_argument("--mock-port", type=int, default=3411)
+    parser.add_argument("--mock-latency-ms", type=float, default=20.0)
+    parser.add_argument("--secret", default="load-test-secret")
+    parser.add_argument("--reply-timeout", type=float, default=30.0)
+    parser.add_argument("--ready-timeout", type=float, default=300.0)
+    args = parser.parse_args()
+
+    processes = []
+    try:
+        if args.mock_url is None:
+            args.mock_url = f"http://127.0.0.1:{args.mock_port}"
+            processes.append(start_server(args.mock_port, args.mock_latency_ms))
+        if args.app_url is None:
+            args.app_url = f"http://127.0.0.1:{args.app_port}"
+            processes.append(start_app(args, tempfile.mkdtemp()))
+        # FAQ の読み込み（モデル・インデックス）が終わってから計測を始める
+        if not wait_ready(args.app_url, args.ready_timeout):
+            sys.exit(f"app is not ready: {args.app_url}")
+        asyncio.run(main(args))
+    finally:
+        for process in processes:
+            process.terminate()
@@ -0,0 +1,171 @@
+"""
+負荷試験用の LINE Messaging API のモックサーバー
+
+    rye run uvicorn scripts.mock_line_server:app --port 3400
+
+アプリ側は LINE_API_BASE_URL=http://127.0.0.1:3400 でこのサーバーに向ける。
+MOCK_LINE_LATENCY_MS（応答までの遅延）と MOCK_LINE_ERROR_RATE（429 / 500 を返す割合）で
+LINE 側の遅延や混雑を再現できる。受信した件数は GET /_stats で取得できる。
+GET /_replies/{reply_token} は、その reply_token への返信が届くまで待って受信時刻を返す。
+"""
+
+import asyncio
+import multiprocessing
+import os
+import random
+import time
+from collections import Counter
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+def create_app(latency_ms=0.0, error_rate=0.0):
+    app = FastAPI()
+    state = {
+        "requests": Counter(),
+        "errors": Counter(),
+        "recipients": 0,
+        "messages": 0,
+        "duplicates": 0,
+        "retry_keys": set(),
+        # reply_token → 受信時刻（time.time()）。エンドツーエンドの遅延の計測に使う
+        "replies": {},
+        # reply_token → 返信の到着を待っている GET /_replies/{reply_token} の Event
+        "waiters": {},
+    }
+    app.state.mock = state
+
+    async def simulate(kind, request):
+        state["requests"][kind] += 1
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        if error_rate and random.random() < error_rate:
+            status = random.choice([429, 500])
+            state["errors"][status] += 1
+            return JSONResponse({"message": "mock error"}, status_code=status)
+
+        retry_key = request.headers.get("X-Line-Retry-Key")
+        if retry_key is not None:
+            if retry_key in state["retry_keys"]:
+                state["duplicates"] += 1
+                return JSONResponse(
+                    {"message": "The retry key is already accepted"}, status_code=409
+                )
+            state["retry_keys"].add(retry_key)
+        return None
+
+    @app.post("/v2/bot/message/reply")
+    async def reply(request: Request):
+        body = await request.json()
+        received_at = time.time()
+        error = await simulate("reply", request)
+        if error is not None:
+            return error
+        state["replies"][body["replyToken"]] = received_at
+        state["messages"] += len(body["messages"])
+        waiter = state["waiters"].get(body["replyToken"])
+        if waiter is not None:
+            waiter.set()
+        return {"sentMessages": []}
+
+    @app.post("/v2/bot/message/push")
+    async def push(request: Request):
+        body = await request.json()
+        error = await simulate("push", request)
+        if error is not None:
+            return error
+        state["recipients"] += 1
+        state["messages"] += len(body["messages"])
+        return {"sentMessages": []}
+
+    @app.post("/v2/bot/message/multicast")
+    async def multicast(request: Request):
+        body = await request.json()
+        error = await simulate("multicast", request)
+        if error is not None:
+            return error
+        state["recipients"] += len(body["to"])
+        state["messages"] += len(body["messages"]) * len(body["to"])
+        return {}
+
+    @app.post("/v2/bot/chat/loading/start")
+    async def loading(request: Request):
+        error = await simulate("loading", request)
+        if error is not None:
+            return error
+        return {}
+
+    @app.get("/_stats")
+    async def stats():
+        return {
+            "requests": dict(state["requests"]),
+            "errors": dict(state["errors"]),
+            "recipients": state["recipients"],
+            "messages": state["messages"],
+            "duplicates": state["duplicates"],
+            "replies": state["replies"],
+        }
+
+    @app.get("/_replies/{reply_token}")
+    async def wait_reply(reply_token: str, timeout: float = 10.0):
+        # 返信が届くまで（最大 timeout 秒）待ち、受信時刻を返す（届かなければ null）
+        if reply_token not in state["replies"]:
+            waiter = state["waiters"].setdefault(reply_token, asyncio.Event())
+            try:
+                await asyncio.wait_for(waiter.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                state["waiters"].pop(reply_token, None)
+        return {"received_at": state["replies"].get(reply_token)}
+
+    @app.post("/_reset")
+    async def reset():
+        state["requests"].clear()
+        state["errors"].clear()
+        state["recipients"] = 0
+        state["messages"] = 0
+        state["duplicates"] = 0
+        state["retry_keys"].clear()
+        state["replies"].clear()
+        return {}
+
+    return app
+
+
+def _serve(port, latency_ms, error_rate):
+    import uvicorn
+
+    uvicorn.run(
+        create_app(latency_ms, error_rate),
+        host="127.0.0.1",
+        port=port,
+        log_level="warning",
+    )
+
+
+def start_server(port, latency_ms=0.0, error_rate=0.0):
+    """モックサーバーを別プロセスで起動する（ベンチマークスクリプトから使う）
+
+    計測対象と GIL を取り合わないよう、スレッドではなくプロセスで動かす。
+    終了するときは返り値の terminate() を呼ぶ。
+    """
+    import httpx
+
+    process = multiprocessing.Process(
+        target=_serve, args=(port, latency_ms, error_rate), daemon=True
+    )
+    process.start()
+    while True:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/_stats")
+            return process
+        except httpx.TransportError:
+            time.sleep(0.1)
+
+
+app = create_app(
+    float(os.getenv("MOCK_LINE_LATENCY_MS", "0")),
+    float(os.getenv("MOCK_LINE_ERROR_RATE", "0")),
+)
@@ -0,0 +1,88 @@
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from src.metrics import faq_cache_lookups_total
+
+
+def normalize_text(text):
+    """NFKC 正規化し、空白（全角スペース・改行を含む）をすべて取り除く"""
+    return "".join(unicodedata.normalize("NFKC", text).split())
+
+
+class AnswerCache:
+    """埋め込みモデルの前段に置く、質問文 → (FAQ の行番号, スコア) のキャッシュ
+
+    - exact: FAQ の Question と正規化後に一致する入力は、その行をそのまま返す
+    - pinned: クイックリプライの Option_question の文字列。初回だけモデルで検索し、
+      以後は追い出さずに保持する
+    - recent: それ以外の最近の入力の LRU（max_size 件まで）
+    """
+
+    def __init__(self, questions, option_questions, max_size=1024):
+        self.exact = {}
+        for index, question in enumerate(questions):
+            key = normalize_text(question)
+            if key:
+                self.exact.setdefault(key, (index, 1.0))
+
+        self.pinned_keys = set()
+        for option_question in option_questions:
+            for text in option_question.split("\t"):
+                key = normalize_text(text)
+                if key and key not in self.exact:
+                    self.pinned_keys.add(key)
+        self.pinned = {}
+
+        self.recent = OrderedDict()
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self.hits = {"exact": 0, "pinned": 0, "recent": 0}
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            result = self.exact.get(key)
+            if result is not None:
+                self.hits["exact"] += 1
+                faq_cache_lookups_total.inc("exact")
+                return result
+            result = self.pinned.get(key)
+            if result is not None:
+                self.hits["pinned"] += 1
+                faq_cache_lookups_total.inc("pinned")
+                return result
+            result = self.recent.get(key)
+            if result is not None:
+                self.recent.move_to_end(key)
+                self.hits["recent"] += 1
+                faq_cache_lookups_total.inc("recent")
+                return result
+            self.misses += 1
+            faq_cache_lookups_total.inc("miss")
+            return None
+
+    def put(self, key, result):
+        with self._lock:
+            if key in self.pinned_keys:
+                self.pinned[key] = result
+                return
+            if self.max_size <= 0:
+                return
+            self.recent[key] = result
+            self.recent.move_to_end(key)
+            while len(self.recent) > self.max_size:
+                self.recent.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            hits = sum(self.hits.values())
+            total = hits + self.misses
+            return {
+                "hits": dict(self.hits),
+                "misses": self.misses,
+                "hit_rate": hits / total if total else 0.0,
+                "recent_size": len(self.recent),
+                "pinned_size": len(self.pinned),
+            }
@@ -0,0 +1,120 @@
+import asyncio
+import contextvars
+
+from src.metrics import current_trace, run_with_traces
+
+
+class BatcherClosedError(RuntimeError):
+    """close() の後に投入された、または close() の時点で処理されていなかった入力"""
+
+
+class MicroBatcher:
+    """短い時間窓に届いた入力をまとめて、1 回の batch_fn 呼び出しで処理する
+
+    batch_fn は入力のリストを受け取り、同じ順序で結果のリストを返す関数。
+    スレッドプール上で実行されるので、イベントループはブロックされない。
+    実行中のバッチ数は max_in_flight までに制限し、空きを待つ間に届いた入力は
+    次のバッチにまとめる（負荷が高いほどバッチが大きくなる）。
+    close() の時点でまだ batch_fn に渡していない入力は、BatcherClosedError で終わらせる。
+    batch_fn の中で記録した処理段階の時間は、バッチに含まれるすべての呼び出し元のトレースに残る。
+    """
+
+    def __init__(
+        self, batch_fn, executor, max_batch_size=32, max_wait=0.01, max_in_flight=1
+    ):
+        self.batch_fn = batch_fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_in_flight = max_in_flight
+        self._queue = None
+        self._full = None
+        self._slots = None
+        self._task = None
+        self._pending = set()
+        # まとめている途中で、まだ _process に渡していないバッチ
+        self._collecting = []
+        self._closed = False
+
+    def _start(self):
+        # asyncio のオブジェクトは実行中のイベントループ上で作る
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._full = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._task = loop.create_task(self._run())
+
+    async def submit(self, item):
+        if self._closed:
+            raise BatcherClosedError("micro batcher is closed")
+        if self._task is None or self._task.done():
+            self._start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, future, current_trace()))
+        if self._queue.qsize() >= self.max_batch_size - 1:
+            self._full.set()
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = self._collecting = [await self._queue.get()]
+            await self._slots.acquire()
+
+            # 時間窓の間、後続の入力を待つ（バッチが埋まれば即座に打ち切る）
+            if self.max_wait > 0 and self._queue.qsize() < self.max_batch_size - 1:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_wait)
+                except asyncio.TimeoutError:
+                    pass
+
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            self._collecting = []
+            task = loop.create_task(self._process(batch))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    async def _process(self, batch):
+        loop = asyncio.get_running_loop()
+        items = [item for item, _, _ in batch]
+        traces = [trace for _, _, trace in batch]
+        try:
+            # スレッドプールには contextvars が引き継がれないので、呼び出し元のトレースを渡す
+            results = await loop.run_in_executor(
+                self.executor,
+                contextvars.copy_context().run,
+                run_with_traces,
+                traces,
+                self.batch_fn,
+                items,
+            )
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def close(self):
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            # 待っている呼び出し元が止まったままにならないよう、未処理の入力を例外で終わらせる
+            unprocessed = self._collecting
+            self._collecting = []
+            while not self._queue.empty():
+                unprocessed.append(self._queue.get_nowait())
+            for _, future, _ in unprocessed:
+                if not future.done():
+                    future.set_exception(BatcherClosedError("micro batcher is closed"))
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
@@ -0,0 +1,129 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from src.utils import save_messages_to_db
+
+
+# キューの上限・1 回に書き込む最大件数・書き込み間隔（秒）
+CHAT_LOG_QUEUE_SIZE = int(os.getenv("CHAT_LOG_QUEUE_SIZE", "10000"))
+CHAT_LOG_BATCH_SIZE = int(os.getenv("CHAT_LOG_BATCH_SIZE", "100"))
+CHAT_LOG_FLUSH_INTERVAL = float(os.getenv("CHAT_LOG_FLUSH_INTERVAL", "0.5"))
+# キューが一杯のときの動作
+# "block": 空きができるまで待つ（ログは失わない） / "drop": 破棄して件数を数える
+CHAT_LOG_OVERFLOW = os.getenv("CHAT_LOG_OVERFLOW", "block")
+
+_STOP = object()
+
+
+class ChatLogWriter:
+    """chat_logs への書き込みをバックグラウンドでまとめて行う
+
+    ハンドラは write() でキューに積むだけで、返信の処理を待たせない。
+    バックグラウンドのタスクが batch_size 件たまるか flush_interval 秒経つごとに、
+    専用のスレッドで 1 トランザクションにまとめて書き込む。
+    stop() はキューに残っているログをすべて書き込んでから終了する。
+    """
+
+    def __init__(
+        self,
+        max_queue_size=CHAT_LOG_QUEUE_SIZE,
+        batch_size=CHAT_LOG_BATCH_SIZE,
+        flush_interval=CHAT_LOG_FLUSH_INTERVAL,
+        overflow=CHAT_LOG_OVERFLOW,
+    ):
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        # 書き込みは 1 スレッドで行う（SQLite の書き込みは直列なので十分）
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-log")
+        self._queue = None
+        self._full = None
+        self._task = None
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._full = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def write(
+        self, user_id, message_id, user_message, response_id, reply_id, timestamp, version
+    ):
+        row = (user_id, message_id, user_message, response_id, reply_id, timestamp, version)
+
+        # start() 前（スクリプトなど）は、その場で書き込む
+        if self._task is None or self._task.done():
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, save_messages_to_db, [row])
+            self.written += 1
+            return
+
+        if self.overflow == "drop":
+            try:
+                self._queue.put_nowait(row)
+            except asyncio.QueueFull:
+                self.dropped += 1
+                print(f"chat log dropped (queue full): {user_id} {message_id}")
+                return
+        else:
+            await self._queue.put(row)
+
+        if self._queue.qsize() >= self.batch_size:
+            self._full.set()
+
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+            batch.append(item)
+
+            # batch_size 件たまるか、flush_interval 秒経つまで待つ
+            if self._queue.qsize() < self.batch_size - 1:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            while len(batch) < self.batch_size and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, save_messages_to_db, batch)
+        except Exception as e:
+            self.failed += len(batch)
+            print(f"chat log flush failed ({len(batch)} rows): {e!r}")
+            return
+        self.written += len(batch)
+
+    async def stop(self):
+        """キューに残っているログを書き込んでから停止する"""
+        if self._task is None:
+            return
+        if not self._task.done():
+            await self._queue.put(_STOP)
+            self._full.set()
+            await self._task
+        self._task = None
+        self.executor.shutdown(wait=True)
+
+
+chat_log_writer = ChatLogWriter()
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from src.process_lock import file_lock
+
+
+# インデックスの形式を変更したら上げる（古いインデックスは作り直す）
+# 2: ベクトルを L2 正規化して保存
+INDEX_FORMAT_VERSION = 2
+META_FILE_NAME = "meta.json"
+BUILD_LOCK_FILE_NAME = ".build.lock"
+
+
+def hash_text(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_meta(index_dir):
+    meta_path = os.path.join(index_dir, META_FILE_NAME)
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != INDEX_FORMAT_VERSION:
+        return None
+    return meta
+
+
+def _load_embeddings(index_dir, meta):
+    """埋め込み行列を mmap で開く（ワーカー間でページキャッシュを共有できる）"""
+    path = os.path.join(index_dir, meta["embeddings_file"])
+    try:
+        embeddings = np.load(path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if embeddings.shape[0] != len(meta["row_hashes"]):
+        return None
+    return embeddings
+
+
+def _write_index(index_dir, embeddings, meta):
+    """埋め込み行列 → meta.json の順に書き出す
+
+    埋め込みファイル名には内容のキーを含めるので、meta.json の置き換えが
+    完了するまでは古いインデックスがそのまま読まれる。
+    """
+    os.makedirs(index_dir, exist_ok=True)
+
+    embeddings_path = os.path.join(index_dir, meta["embeddings_file"])
+    tmp_path = embeddings_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, embeddings)
+    os.replace(tmp_path, embeddings_path)
+
+    meta_path = os.path.join(index_dir, META_FILE_NAME)
+    tmp_path = meta_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, meta_path)
+
+    # 参照されなくなった古い埋め込みファイルを削除
+    for name in os.listdir(index_dir):
+        if (
+            name.startswith("embeddings-")
+            and name.endswith(".npy")
+            and name != meta["embeddings_file"]
+        ):
+            try:
+                os.remove(os.path.join(index_dir, name))
+            except OSError:
+                pass
+
+
+def load_or_build_index(index_dir, csv_path, questions, model_name, encode, dtype):
+    """FAQ の質問文の埋め込みをディスク上のインデックスから読み込む
+
+    CSV の内容ハッシュ・モデル名・dtype が一致すればファイルを mmap するだけで返す。
+    一致しない場合は、質問文が変わっていない行のベクトルを再利用し、
+    変更・追加された行だけを encode してインデックスを書き直す。
+    質問が 1 行もない場合は ValueError（空のインデックスでは検索できない）。
+    """
+    if not questions:
+        raise ValueError(f"FAQ data has no rows: {csv_path}")
+    csv_hash = hash_file(csv_path)
+    meta, embeddings = _load_current(index_dir, csv_hash, model_name, dtype)
+    if embeddings is not None:
+        return embeddings
+
+    # 複数のワーカーが同時に起動した場合は 1 プロセスだけが作成し、ほかはその結果を読む
+    with file_lock(os.path.join(index_dir, BUILD_LOCK_FILE_NAME)):
+        meta, embeddings = _load_current(index_dir, csv_hash, model_name, dtype)
+        if embeddings is not None:
+            return embeddings
+        return _build_index(index_dir, csv_hash, questions, model_name, encode, dtype, meta)
+
+
+def _load_current(index_dir, csv_hash, model_name, dtype):
+    """(meta, 埋め込み行列) を返す。インデックスが最新でなければ埋め込み行列は None"""
+    meta = _read_meta(index_dir)
+    if (
+        meta is not None
+        and meta["csv_hash"] == csv_hash
+        and meta["model_name"] == model_name
+        and meta["dtype"] == dtype
+    ):
+        return meta, _load_embeddings(index_dir, meta)
+    return meta, None
+
+
+def _build_index(index_dir, csv_hash, questions, model_name, encode, dtype, meta):
+    row_hashes = [hash_text(question) for question in questions]
+
+    # 既存のインデックスから再利用できるベクトル
+    reusable = {}
+    if meta is not None and meta["model_name"] == model_name:
+        old_embeddings = _load_embeddings(index_dir, meta)
+        if old_embeddings is not None:
+            for i, row_hash in enumerate(meta["row_hashes"]):
+                reusable.setdefault(row_hash, old_embeddings[i])
+
+    changed_rows = [i for i, h in enumerate(row_hashes) if h not in reusable]
+    print(
+        f"FAQ index: reuse {len(questions) - len(changed_rows)} rows, encode {len(changed_rows)} rows"
+    )
+
+    encoded = None
+    if changed_rows:
+        encoded = np.asarray(encode([questions[i] for i in changed_rows]))
+
+    if encoded is not None:
+        dim = encoded.shape[1]
+    else:
+        # すべての行を再利用する（questions は空でないので reusable も空でない）
+        dim = next(iter(reusable.values())).shape[0]
+    embeddings = np.empty((len(questions), dim), dtype=dtype)
+    for i, row_hash in enumerate(row_hashes):
+        if row_hash in reusable:
+            embeddings[i] = reusable[row_hash]
+    for j, i in enumerate(changed_rows):
+        embeddings[i] = encoded[j]
+
+    key = hash_text(f"{csv_hash}:{model_name}:{dtype}")[:16]
+    meta = {
+        "version": INDEX_FORMAT_VERSION,
+        "model_name": model_name,
+        "csv_hash": csv_hash,
+        "dtype": dtype,
+        "embeddings_file": f"embeddings-{key}.npy",
+        "row_hashes": row_hashes,
+    }
+    _write_index(index_dir, embeddings, meta)
+
+    return _load_embeddings(index_dir, meta)
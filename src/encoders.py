@@ -0,0 +1,211 @@
+import os
+import threading
+
+import numpy as np
+
+
+MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+# ONNX 版モデルの置き場所（scripts/export_onnx.py で作成する）
+ONNX_MODEL_DIR = "./data/models/paraphrase-multilingual-MiniLM-L12-v2-onnx"
+ONNX_MODEL_FILE = "model.int8.onnx"
+
+
+def _normalize(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    np.maximum(norms, 1e-12, out=norms)
+    return np.ascontiguousarray(embeddings / norms)
+
+
+class SentenceTransformerEncoder:
+    """PyTorch（sentence-transformers）で encode するバックエンド"""
+
+    backend = "torch"
+
+    def __init__(self, model_name=MODEL_NAME):
+        self.model_name = model_name
+        # 既存のインデックスをそのまま使えるよう、モデル名だけを識別子にする
+        self.identifier = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        # torch の読み込みは重いので、最初に encode が必要になったときに行う
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+
+                    model = SentenceTransformer(self.model_name)
+                    model.eval()
+                    self._model = model
+        return self._model
+
+    def encode(self, texts):
+        # L2 正規化した float32 のベクトルを返す
+        embeddings = self.load().encode(
+            list(texts), convert_to_numpy=True, normalize_embeddings=True
+        )
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
+class OnnxEncoder:
+    """ONNX Runtime で encode するバックエンド（torch を読み込まない）
+
+    model_dir には scripts/export_onnx.py が出力した ONNX モデルと tokenizer.json を置く。
+    プーリングは sentence-transformers と同じ mean pooling。
+    """
+
+    backend = "onnx"
+
+    def __init__(
+        self,
+        model_dir=ONNX_MODEL_DIR,
+        model_file=ONNX_MODEL_FILE,
+        model_name=MODEL_NAME,
+        max_length=128,
+        num_threads=0,
+    ):
+        self.model_dir = model_dir
+        self.model_file = model_file
+        self.model_name = model_name
+        self.max_length = max_length
+        self.num_threads = num_threads
+        # 量子化の有無でベクトルが変わるので、ファイル名も識別子に含める
+        self.identifier = f"{model_name}:onnx:{model_file}"
+        self._session = None
+        self._tokenizer = None
+        self._input_names = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import onnxruntime
+                    from tokenizers import Tokenizer
+
+                    tokenizer = Tokenizer.from_file(
+                        os.path.join(self.model_dir, "tokenizer.json")
+                    )
+                    tokenizer.enable_truncation(max_length=self.max_length)
+                    pad_id = tokenizer.token_to_id("<pad>")
+                    tokenizer.enable_padding(
+                        pad_id=pad_id if pad_id is not None else 0
+                    )
+
+                    options = onnxruntime.SessionOptions()
+                    if self.num_threads:
+                        options.intra_op_num_threads = self.num_threads
+                    session = onnxruntime.InferenceSession(
+                        os.path.join(self.model_dir, self.model_file),
+                        options,
+                        providers=["CPUExecutionProvider"],
+                    )
+                    self._input_names = {i.name for i in session.get_inputs()}
+                    self._tokenizer = tokenizer
+                    self._session = session
+        return self._session
+
+    def encode(self, texts):
+        session = self.load()
+        encodings = self._tokenizer.encode_batch(list(texts))
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self._input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+        token_embeddings = session.run(None, inputs)[0]
+
+        # mean pooling（パディングを除いたトークンの平均）
+        mask = attention_mask[:, :, None].astype(np.float32)
+        summed = (token_embeddings * mask).sum(axis=1)
+        counts = np.maximum(mask.sum(axis=1), 1e-9)
+        return _normalize(summed / counts)
+
+
+def create_encoder(backend, **kwargs):
+    """設定値からエンコーダを作成する（"torch" または "onnx"）"""
+    if backend == "torch":
+        return SentenceTransformerEncoder(**kwargs)
+    if backend == "onnx":
+        return OnnxEncoder(**kwargs)
+    raise ValueError(f"Unknown encoder backend: {backend}")
+
+
+def export_onnx(output_dir, model_name=MODEL_NAME, quantize=True):
+    """sentence-transformers のモデルを ONNX に書き出し、int8 の動的量子化を行う
+
+    torch と transformers が必要なので、サービング環境ではなく開発環境で実行する。
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name)
+    model.eval()
+
+    # tokenizer.json（tokenizers ライブラリだけで読める形式）を保存
+    tokenizer.save_pretrained(output_dir)
+
+    sample = tokenizer(["サンプル"], return_tensors="pt")
+    onnx_path = os.path.join(output_dir, "model.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (sample["input_ids"], sample["attention_mask"]),
+            onnx_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["token_embeddings"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "token_embeddings": {0: "batch", 1: "sequence"},
+            },
+            opset_version=14,
+        )
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(
+            onnx_path,
+            os.path.join(output_dir, "model.int8.onnx"),
+            weight_type=QuantType.QInt8,
+        )
+
+
+def check_parity(reference, candidate, faq_questions, queries=()):
+    """2 つのエンコーダで FAQ の検索結果（top-1）が一致するかを確認する
+
+    - FAQ の各質問について、自分自身を除いた最も近い質問が一致する割合
+    - queries（クイックリプライの文字列など）について、top-1 が一致する割合
+    - 同じ文に対する 2 つのベクトルのコサイン類似度の平均
+    """
+    ref_index = reference.encode(faq_questions)
+    cand_index = candidate.encode(faq_questions)
+
+    def nearest_other(index):
+        scores = index @ index.T
+        np.fill_diagonal(scores, -np.inf)
+        return np.argmax(scores, axis=1)
+
+    result = {
+        "questions": len(faq_questions),
+        "question_agreement": float(
+            np.mean(nearest_other(ref_index) == nearest_other(cand_index))
+        ),
+        "mean_cosine": float(np.mean(np.sum(ref_index * cand_index, axis=1))),
+    }
+
+    queries = list(queries)
+    if queries:
+        ref_top1 = np.argmax(reference.encode(queries) @ ref_index.T, axis=1)
+        cand_top1 = np.argmax(candidate.encode(queries) @ cand_index.T, axis=1)
+        result["queries"] = len(queries)
+        result["query_agreement"] = float(np.mean(ref_top1 == cand_top1))
+
+    return result
@@ -0,0 +1,111 @@
+import asyncio
+import os
+from collections import deque
+
+from src.metrics import observe
+
+
+# 同時に処理するイベント数の上限（ユーザーが異なるイベントは並行して処理する）
+EVENT_CONCURRENCY = int(os.getenv("EVENT_CONCURRENCY", "100"))
+# 終了時に未処理のイベントを待つ最大秒数
+EVENT_DRAIN_TIMEOUT = float(os.getenv("EVENT_DRAIN_TIMEOUT", "20"))
+
+
+class UserEventQueue:
+    """webhook のイベントをプロセス内のキューに積み、バックグラウンドで処理する
+
+    - 同じユーザー（key）のイベントは届いた順に 1 件ずつ処理する
+    - 異なるユーザーのイベントは並行して処理する（同時に concurrency 件まで）
+    - stop() は受け付けを止め、キューに残っているイベントを処理し終えるまで待つ
+
+    ハンドラで起きた例外はログに出して数えるだけで、次のイベントの処理を続ける。
+    """
+
+    def __init__(self, handler, concurrency=EVENT_CONCURRENCY):
+        self.handler = handler
+        self.concurrency = concurrency
+        # key → 未処理のイベント (event, キューに積んだ時刻) の deque
+        self._pending = {}
+        self._tasks = set()
+        self._semaphore = None
+        self._stopping = False
+        self.depth = 0
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        # キューに積んでから処理を始めるまでの時間（秒）
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.lag_total = 0.0
+
+    def submit(self, key, event):
+        """イベントをキューに積む（処理の完了は待たない）"""
+        if self._stopping:
+            raise RuntimeError("event queue is stopping")
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        self.enqueued += 1
+        self.depth += 1
+        item = (event, loop.time())
+        queue = self._pending.get(key)
+        if queue is not None:
+            # このユーザーのイベントを処理中のタスクが続けて処理する
+            queue.append(item)
+            return
+        self._pending[key] = deque([item])
+        task = loop.create_task(self._run(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key):
+        loop = asyncio.get_running_loop()
+        queue = self._pending[key]
+        try:
+            while queue:
+                event, enqueued_at = queue[0]
+                async with self._semaphore:
+                    lag = loop.time() - enqueued_at
+                    self.lag_last = lag
+                    self.lag_max = max(self.lag_max, lag)
+                    self.lag_total += lag
+                    observe("event_queue_wait", lag)
+                    try:
+                        await self.handler(event)
+                    except Exception as e:
+                        self.failed += 1
+                        print(f"event handling failed: {key} {e!r}")
+                    finally:
+                        queue.popleft()
+                        self.depth -= 1
+                        self.processed += 1
+        finally:
+            # キャンセルされた場合も、残りのイベントを数から外す
+            self.depth -= len(queue)
+            del self._pending[key]
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "active_users": len(self._pending),
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "lag_last": self.lag_last,
+            "lag_max": self.lag_max,
+            "lag_avg": self.lag_total / self.processed if self.processed else 0.0,
+        }
+
+    async def stop(self, timeout=EVENT_DRAIN_TIMEOUT):
+        """新しいイベントの受け付けを止め、処理中・未処理のイベントを処理し終えるまで待つ"""
+        self._stopping = True
+        if not self._tasks:
+            return
+        print(f"draining {self.depth} events")
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            print(f"event queue drain timed out: {len(pending)} users cancelled")
@@ -0,0 +1,58 @@
+import csv
+import sys
+
+
+class FaqEntry:
+    """FAQ の 1 行。get_response が返す値を読み込み時に組み立てておく
+
+    reply は (response, option, option_question) で、すべての呼び出しで同じオブジェクトを返すので、
+    受け取った側でリストを変更しないこと。
+    """
+
+    __slots__ = ("question", "qestion_interpreting", "option_question", "reply", "log_no_option")
+
+    def __init__(self, question, answer, url, qestion_interpreting, option, option_question):
+        self.question = question
+        # 文字 n-gram の検索（LexicalIndex）で Question と合わせて使う
+        self.qestion_interpreting = qestion_interpreting
+        # 正規化前の Option_question（AnswerCache の固定キーに使う）
+        self.option_question = option_question
+        self.log_no_option = False
+        if url != "":
+            response = [answer]
+            response.extend(_split(url))
+            self.reply = (response, option, option_question)
+        elif option != "":
+            self.reply = (
+                [qestion_interpreting],
+                _split(option),
+                _split(option_question),
+            )
+        else:
+            self.reply = ([answer], option, option_question)
+            self.log_no_option = True
+
+
+def _split(text):
+    # 選択肢や URL は同じ文字列が多くの行で繰り返されるので intern して共有する
+    return [sys.intern(part) for part in text.split("\t")]
+
+
+def load_faq_entries(path):
+    """FAQ の CSV を読み込み、FaqEntry のリストを返す（pandas を使わない）
+
+    空欄は空文字列として扱う。
+    """
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        reader = csv.DictReader(f)
+        return [
+            FaqEntry(
+                row["Question"] or "",
+                row["Answer"] or "",
+                sys.intern(row["URL"] or ""),
+                row["Qestion_interpreting"] or "",
+                sys.intern(row["Option"] or ""),
+                sys.intern(row["Option_question"] or ""),
+            )
+            for row in reader
+        ]
@@ -1,67 +1,453 @@
-import pandas as pd
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+from dotenv import load_dotenv
+
+from src.answer_cache import AnswerCache, normalize_text
+from src.batching import BatcherClosedError, MicroBatcher
+from src.embedding_index import load_or_build_index
+from src.faq_store import load_faq_entries
+from src.lexical import LexicalIndex
+from src.metrics import Counter, stage
+from src.prefilter import FALLBACK_MESSAGES, prefilter
+from src.encoders import ONNX_MODEL_DIR, ONNX_MODEL_FILE, create_encoder
+from src.vector_index import create_vector_index
+
+
+load_dotenv()
+
+# 質問文を encode するバックエンド（"torch" または "onnx"）
+# onnx を選ぶとサービング中のプロセスでは torch を読み込まない
+FAQ_ENCODER_BACKEND = os.getenv("FAQ_ENCODER_BACKEND", "torch")
+FAQ_ONNX_MODEL_DIR = os.getenv("FAQ_ONNX_MODEL_DIR", ONNX_MODEL_DIR)
+FAQ_ONNX_MODEL_FILE = os.getenv("FAQ_ONNX_MODEL_FILE", ONNX_MODEL_FILE)
+
+# 埋め込みインデックスの保存先と保存形式（float32 / float16）
+# float32 ならワーカー間で mmap のページを共有する。float16 はファイルが半分になるが、
+# 読み込み時に float32 に変換するので、ワーカーごとに float32 の行列を持つ（共有されない）
+FAQ_INDEX_DIR = os.getenv("FAQ_INDEX_DIR", "./data/outputs/faq_index")
+FAQ_INDEX_DTYPE = os.getenv("FAQ_INDEX_DTYPE", "float32")
+
+# 類似度検索の方式（"brute": 全件との内積 / "ivf": 近似最近傍検索）
+# FAQ が数十万件規模になる場合は ivf を使う（scripts/bench_vector_index.py で精度と速度を確認できる）
+# ivf もベクトルは mmap したインデックスから読むのでワーカー間で共有されるが、クラスタの中心と
+# 割り当てはワーカーごとに計算する。FAQ を読み直すと、変わらなかった行も含めて k-means からやり直す
+FAQ_VECTOR_INDEX = os.getenv("FAQ_VECTOR_INDEX", "brute")
+# ivf のクラスタ数（0 なら件数から決める）と、検索するクラスタ数
+FAQ_IVF_NLIST = int(os.getenv("FAQ_IVF_NLIST", "0"))
+FAQ_IVF_NPROBE = int(os.getenv("FAQ_IVF_NPROBE", "8"))
+
+# 文字 n-gram（BM25）の検索との組み合わせ方
+# "off": 埋め込みのみ / "fusion": 埋め込みと文字 n-gram の上位候補を合わせて並べ直す /
+# "candidates": 文字 n-gram の上位候補だけを埋め込みで並べ直す（一致する n-gram がなければ全件を検索）
+FAQ_HYBRID = os.getenv("FAQ_HYBRID", "off")
+# 並べ直す候補の数（埋め込み・文字 n-gram それぞれの上位件数）
+FAQ_HYBRID_CANDIDATES = int(os.getenv("FAQ_HYBRID_CANDIDATES", "50"))
+# 並べ直しのスコア = 埋め込みの重み × コサイン類似度 + 文字 n-gram の重み × BM25（1 位を 1 とした値）
+FAQ_DENSE_WEIGHT = float(os.getenv("FAQ_DENSE_WEIGHT", "0.7"))
+FAQ_LEXICAL_WEIGHT = float(os.getenv("FAQ_LEXICAL_WEIGHT", "0.3"))
 
-from sklearn.metrics.pairwise import cosine_similarity
-from sentence_transformers import SentenceTransformer
+# 検索（encode + 類似度計算）を実行するスレッド数
+# torch / onnxruntime の推論中は GIL が解放されるので、プロセスではなくスレッドで十分
+FAQ_EXECUTOR_WORKERS = int(os.getenv("FAQ_EXECUTOR_WORKERS", "2"))
+
+# 同時に届いた質問をまとめて encode するための時間窓（ミリ秒）と最大バッチサイズ
+FAQ_BATCH_WINDOW_MS = float(os.getenv("FAQ_BATCH_WINDOW_MS", "10"))
+FAQ_BATCH_MAX_SIZE = int(os.getenv("FAQ_BATCH_MAX_SIZE", "32"))
+
+# 最近の質問 → 検索結果のキャッシュの件数（0 で無効）
+FAQ_CACHE_SIZE = int(os.getenv("FAQ_CACHE_SIZE", "1024"))
+
+# 類似度（コサイン）がこの値未満なら FAQ の回答ではなく定型文を返す（0 で無効）
+# 値は scripts/evaluate_retrieval.py の --thresholds の結果を見て決める
+FAQ_SCORE_THRESHOLD = float(os.getenv("FAQ_SCORE_THRESHOLD", "0"))
+# 挨拶・記号のみ・短すぎる入力を、モデルを通さずに定型文で返すか
+FAQ_PREFILTER = os.getenv("FAQ_PREFILTER", "1") == "1"
+FAQ_MIN_QUERY_LENGTH = int(os.getenv("FAQ_MIN_QUERY_LENGTH", "2"))
+
+# データセットのパス
+FAQ_DATA_PATH = os.getenv(
+    "FAQ_DATA_PATH", "./data/inputs/NCC_FAQdata_20250115_for_line.csv"
+)
+# データセットの更新を確認する間隔（秒）。0 なら確認しない（管理用エンドポイントからのみ読み直す）
+FAQ_WATCH_INTERVAL = float(os.getenv("FAQ_WATCH_INTERVAL", "0"))
+# 読み直した後、古い FaqService を閉じるまでの秒数（置き換え前に受け付けた質問の処理を待つ）
+FAQ_RELOAD_GRACE_SECONDS = float(os.getenv("FAQ_RELOAD_GRACE_SECONDS", "30"))
+
+
+fallbacks_total = Counter(
+    "chatbot_faq_fallbacks_total", "FAQ の回答の代わりに定型文を返した数", "reason"
+)
 
 
 class FaqService:
-    def __init__(self, faq_data_path):
-        self.data = pd.read_csv(faq_data_path)
-        self.questions = self.data["Question"].fillna("")
-        self.answers = self.data["Answer"].fillna("")
-        self.url = self.data["URL"].fillna("")
-        self.qestion_interpreting = self.data["Qestion_interpreting"].fillna("")
-        self.option = self.data["Option"].fillna("")
-        self.option_question = self.data["Option_question"].fillna("")
-        self.model = SentenceTransformer(
-            "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+    def __init__(
+        self,
+        faq_data_path,
+        index_dir=FAQ_INDEX_DIR,
+        index_dtype=FAQ_INDEX_DTYPE,
+        executor_workers=FAQ_EXECUTOR_WORKERS,
+        batch_window_ms=FAQ_BATCH_WINDOW_MS,
+        batch_max_size=FAQ_BATCH_MAX_SIZE,
+        cache_size=FAQ_CACHE_SIZE,
+        encoder=None,
+        vector_index=FAQ_VECTOR_INDEX,
+        ivf_nlist=FAQ_IVF_NLIST,
+        ivf_nprobe=FAQ_IVF_NPROBE,
+        score_threshold=FAQ_SCORE_THRESHOLD,
+        prefilter_enabled=FAQ_PREFILTER,
+        min_query_length=FAQ_MIN_QUERY_LENGTH,
+        hybrid=FAQ_HYBRID,
+        hybrid_candidates=FAQ_HYBRID_CANDIDATES,
+        dense_weight=FAQ_DENSE_WEIGHT,
+        lexical_weight=FAQ_LEXICAL_WEIGHT,
+    ):
+        if hybrid not in ("off", "fusion", "candidates"):
+            raise ValueError(f"unknown hybrid mode: {hybrid}")
+        self.score_threshold = score_threshold
+        self.prefilter_enabled = prefilter_enabled
+        self.min_query_length = min_query_length
+        self.hybrid = hybrid
+        self.hybrid_candidates = hybrid_candidates
+        self.dense_weight = dense_weight
+        self.lexical_weight = lexical_weight
+        # 応答の組み立てに必要な値は読み込み時に作っておく（pandas は使わない）
+        self.entries = load_faq_entries(faq_data_path)
+        self.questions = [entry.question for entry in self.entries]
+        # 完全一致・正規化後の一致はモデルを通さずに返す
+        self.cache = AnswerCache(
+            self.questions,
+            [entry.option_question for entry in self.entries],
+            cache_size,
+        )
+        if encoder is None:
+            encoder = default_encoder()
+        self.encoder = encoder
+        # イベントループを止めないよう、検索はこのスレッドプールで実行する
+        self.executor = ThreadPoolExecutor(
+            max_workers=executor_workers, thread_name_prefix="faq"
         )
-        self.model.eval()
-        self.embeddings = self.model.encode(self.questions.values)
+        self.batcher = MicroBatcher(
+            self.find_similar_batch,
+            self.executor,
+            max_batch_size=batch_max_size,
+            max_wait=batch_window_ms / 1000,
+            max_in_flight=executor_workers,
+        )
+        # インデックスが最新なら mmap するだけで、モデルの読み込みも encode も行わない
+        # 保存されているベクトルは L2 正規化済みなので、内積がそのままコサイン類似度になる
+        embeddings = load_or_build_index(
+            index_dir,
+            faq_data_path,
+            self.questions,
+            self.encoder.identifier,
+            self.encode,
+            index_dtype,
+        )
+        # float32 の場合は mmap のまま（コピーしない）
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        index_options = {}
+        if vector_index == "ivf":
+            index_options = {"nlist": ivf_nlist, "nprobe": ivf_nprobe}
+        self.index = create_vector_index(vector_index, self.embeddings, **index_options)
+        self.lexical = None
+        if hybrid != "off":
+            self.lexical = LexicalIndex(
+                [f"{entry.question}\n{entry.qestion_interpreting}" for entry in self.entries]
+            )
+
+    def encode(self, texts):
+        # L2 正規化した float32 のベクトルを返す
+        return self.encoder.encode(texts)
+
+    def search(self, input_embeddings, k=1):
+        """正規化済みのクエリベクトルに対して上位 k 件のインデックスとスコアを返す
+
+        返り値はどちらも (クエリ数, k) の配列で、スコアの降順に並ぶ。
+        """
+        return self.index.search(input_embeddings, k)
+
+    def find_similar_batch(self, input_texts):
+        # 複数の質問を 1 回の forward でまとめて encode し、(index, score) を返す
+        with stage("encode"):
+            input_embeddings = self.encode(list(input_texts))
+        if self.lexical is not None:
+            return [
+                self.hybrid_search(text, embedding)
+                for text, embedding in zip(input_texts, input_embeddings)
+            ]
+        with stage("search"):
+            top_indices, top_scores = self.search(input_embeddings, k=1)
+        return list(zip(top_indices[:, 0].tolist(), top_scores[:, 0].tolist()))
+
+    def hybrid_search(self, input_text, input_embedding):
+        """文字 n-gram の BM25 と埋め込みのスコアを合わせて 1 件を選び、(index, score) を返す
+
+        score は選んだ行のコサイン類似度（FAQ_SCORE_THRESHOLD はこの値と比べる）。
+        """
+        with stage("lexical"):
+            lexical_scores = self.lexical.scores(input_text)
+            lexical_indices = np.flatnonzero(lexical_scores)
+            if len(lexical_indices) > self.hybrid_candidates:
+                lexical_indices = lexical_indices[
+                    np.argpartition(
+                        -lexical_scores[lexical_indices], self.hybrid_candidates - 1
+                    )[: self.hybrid_candidates]
+                ]
+        with stage("search"):
+            if self.hybrid == "candidates" and len(lexical_indices):
+                # 埋め込みの類似度は候補の行だけで計算する
+                candidates = lexical_indices
+            else:
+                top_indices, _ = self.search(input_embedding[None, :], k=self.hybrid_candidates)
+                candidates = np.union1d(top_indices[0], lexical_indices)
+            dense_scores = self.embeddings[candidates] @ input_embedding
+            max_lexical = lexical_scores.max() if len(lexical_indices) else 0.0
+            fused = self.dense_weight * dense_scores
+            if max_lexical > 0:
+                fused += self.lexical_weight * (lexical_scores[candidates] / max_lexical)
+            best = int(np.argmax(fused))
+        return int(candidates[best]), float(dense_scores[best])
+
+    def find_similar_topk(self, input_text, k=5):
+        # 上位 k 件の (index, score)。信頼度の確認や次点の候補の提示に使う
+        input_embeddings = self.encode([input_text])
+        top_indices, top_scores = self.search(input_embeddings, k=k)
+        return list(zip(top_indices[0].tolist(), top_scores[0].tolist()))
 
     def find_similar(self, input_text):
-        input_embedding = self.model.encode([input_text])
-        similarity_scores = cosine_similarity(input_embedding, self.embeddings)
-        most_similar_index = np.argmax(similarity_scores)
-        return most_similar_index
+        similar_question_index, _ = self.find_similar_batch([input_text])[0]
+        return similar_question_index
 
     def get_response(self, input_text):
-        similar_question_index = self.find_similar(input_text)
-        response_url = self.url[similar_question_index]
-        response = [self.answers[similar_question_index]]
-        option = self.option[similar_question_index]
-        option_question = self.option_question[similar_question_index]
-        if response_url != "":
-            urls = response_url.split("\t")
-            response.extend(list(urls))
-        else:
-            if option != "":
-                option = option.split("\t")
-                option_question = option_question.split("\t")
-                response = [self.qestion_interpreting[similar_question_index]]
-            else:
-                print("option: None")
+        key = normalize_text(input_text)
+        result = self.cache.get(key)
+        if result is None:
+            reason = self.prefilter_reason(key)
+            if reason is not None:
+                return self.fallback_response(reason)
+            result = self.find_similar_batch([input_text])[0]
+            self.cache.put(key, result)
+        return self.get_response_by_result(result)
+
+    def prefilter_reason(self, key):
+        # 挨拶や記号だけの入力は、モデルを通さずに定型文を返す
+        if not self.prefilter_enabled:
+            return None
+        # クイックリプライの選択肢（Option_question）は、どんな文字列でも必ず検索する
+        if key in self.cache.pinned_keys:
+            return None
+        return prefilter(key, self.min_query_length)
 
+    def fallback_response(self, reason):
+        """定型文の応答。FAQ の行に対応しないので行番号は -1 にする"""
+        fallbacks_total.inc(reason)
+        return [FALLBACK_MESSAGES[reason]], "", "", -1
+
+    def get_response_by_result(self, result):
+        similar_question_index, score = result
+        if score < self.score_threshold:
+            return self.fallback_response("low_score")
+        return self.get_response_by_index(similar_question_index)
+
+    def get_response_by_index(self, similar_question_index):
+        entry = self.entries[similar_question_index]
+        if entry.log_no_option:
+            print("option: None")
+        response, option, option_question = entry.reply
         return response, option, option_question, similar_question_index
 
+    async def aget_response(self, input_text):
+        """get_response の非同期版
+
+        同時に届いた質問はマイクロバッチにまとめてスレッドプールで encode するので、
+        イベントループはブロックされない。
+        """
+        key = normalize_text(input_text)
+        result = self.cache.get(key)
+        if result is None:
+            reason = self.prefilter_reason(key)
+            if reason is not None:
+                return self.fallback_response(reason)
+            # バッチを待つ時間を含めた、モデルでの検索にかかった時間
+            with stage("faq_lookup"):
+                result = await self.batcher.submit(input_text)
+            self.cache.put(key, result)
+        return self.get_response_by_result(result)
+
+    def cache_stats(self):
+        # キャッシュのヒット数・ミス数（ミス数 = モデルで encode した回数）
+        return self.cache.stats()
+
+    async def aclose(self):
+        await self.batcher.close()
+        self.executor.shutdown(wait=False)
+
+
+def default_encoder():
+    if FAQ_ENCODER_BACKEND == "onnx":
+        return create_encoder(
+            "onnx", model_dir=FAQ_ONNX_MODEL_DIR, model_file=FAQ_ONNX_MODEL_FILE
+        )
+    return create_encoder(FAQ_ENCODER_BACKEND)
+
 
 # データセットのパス
-faq_data_path = "./data/inputs/NCC_FAQdata_20250115_for_line.csv"
+faq_data_path = FAQ_DATA_PATH
 
 # FaqServiceの初期化
-faq_service = FaqService(faq_data_path)
+# import 時には作らず、load_faq_service()（起動時のウォームアップ）で作る
+faq_service = None
+_faq_service_lock = threading.Lock()
+
+
+def load_faq_service():
+    """FaqService を作成し、エンコーダを読み込んでおく（作成済みならそれを返す）"""
+    global faq_service
+    if faq_service is None:
+        with _faq_service_lock:
+            if faq_service is None:
+                service = FaqService(faq_data_path)
+                # 最初の質問でモデルの読み込みを待たないよう、ここで読み込む
+                service.encoder.load()
+                faq_service = service
+    return faq_service
+
+
+def is_ready():
+    return faq_service is not None
+
+
+def faq_cache_stats():
+    # 現在の FaqService の回答キャッシュの状況（読み込み前は None。読み直すと数え直す）
+    service = faq_service
+    return service.cache_stats() if service is not None else None
+
+
+# 読み直しの状況（/stats で確認する）
+faq_reload_status = {
+    "reloads": 0,
+    "last_reloaded_at": None,
+    "last_seconds": None,
+    "last_error": None,
+    "rows": None,
+}
+_faq_reload_lock = threading.Lock()
+_retiring_services = set()
+
+
+def reload_faq_service():
+    """CSV を読み直した FaqService を作り、完成してから置き換える
+
+    エンコーダは読み込み済みのものを使い回し、インデックスは質問文が変わった行だけを
+    encode する。作成中の質問は古い FaqService がそのまま処理する。
+    返り値は (新しい FaqService, 古い FaqService)。
+    """
+    global faq_service
+    with _faq_reload_lock:
+        old_service = faq_service
+        if old_service is None:
+            return load_faq_service(), None
+        start = time.perf_counter()
+        new_service = FaqService(faq_data_path, encoder=old_service.encoder)
+        # 参照の置き換えは 1 回の代入なので、途中の状態が見えることはない
+        faq_service = new_service
+        faq_reload_status.update(
+            reloads=faq_reload_status["reloads"] + 1,
+            last_reloaded_at=time.time(),
+            last_seconds=time.perf_counter() - start,
+            last_error=None,
+            rows=len(new_service.questions),
+        )
+    print(
+        f"FAQ reloaded: {len(new_service.questions)} rows in {faq_reload_status['last_seconds']:.3f}s"
+    )
+    return new_service, old_service
+
+
+async def _retire_faq_service(service):
+    await asyncio.sleep(FAQ_RELOAD_GRACE_SECONDS)
+    await service.aclose()
+
+
+async def areload_faq_service():
+    """reload_faq_service をスレッドで実行する。失敗した場合は古い FaqService を使い続ける"""
+    loop = asyncio.get_running_loop()
+    try:
+        _, old_service = await loop.run_in_executor(None, reload_faq_service)
+    except Exception as e:
+        faq_reload_status["last_error"] = repr(e)
+        print(f"FAQ reload failed: {e!r}")
+        return False
+    if old_service is not None:
+        task = loop.create_task(_retire_faq_service(old_service))
+        _retiring_services.add(task)
+        task.add_done_callback(_retiring_services.discard)
+    return True
+
+
+def _data_file_signature():
+    try:
+        stat = os.stat(faq_data_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+async def watch_faq_data(interval=FAQ_WATCH_INTERVAL):
+    """データセットの更新日時・サイズが変わったら読み直す（キャンセルされるまで続ける）"""
+    signature = _data_file_signature()
+    while True:
+        await asyncio.sleep(interval)
+        current = _data_file_signature()
+        if current is None or current == signature:
+            continue
+        # 書き込み途中のファイルを読まないよう、変化が止まってから読み直す
+        await asyncio.sleep(1)
+        if _data_file_signature() != current:
+            continue
+        if not is_ready():
+            # 読み込みが終わってから読み直す
+            continue
+        await areload_faq_service()
+        signature = current
+
+
+async def aload_faq_service():
+    # ウォームアップ中に質問が届いた場合は、読み込みの完了を待つ
+    if faq_service is not None:
+        return faq_service
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, load_faq_service)
 
 
 def find_answer(input_text) -> str:
     # 応答の取得
-    response, option, option_question = faq_service.get_response(input_text)
+    response, option, option_question = load_faq_service().get_response(input_text)
 
     return response
 
 
 def find_option(input_text) -> str:
     # 応答の取得
-    response, option, option_question, index = faq_service.get_response(input_text)
+    response, option, option_question, index = load_faq_service().get_response(
+        input_text
+    )
 
     return response, option, option_question, index
+
+
+async def afind_option(input_text):
+    # 応答の取得（非同期版）
+    service = await aload_faq_service()
+    try:
+        return await service.aget_response(input_text)
+    except BatcherClosedError:
+        # 読み直しで閉じられた古い FaqService に残っていた質問は、新しい FaqService で処理し直す
+        if faq_service is service:
+            raise
+        return await faq_service.aget_response(input_text)
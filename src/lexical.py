@@ -0,0 +1,76 @@
+import math
+from collections import Counter
+
+import numpy as np
+
+from src.answer_cache import normalize_text
+
+
+def char_ngrams(text, sizes=(2, 3)):
+    """正規化した文字列の文字 n-gram のリスト（分かち書きをしない日本語向け）"""
+    text = normalize_text(text).lower()
+    return [text[i : i + n] for n in sizes for i in range(len(text) - n + 1)]
+
+
+class LexicalIndex:
+    """文字 n-gram の転置インデックスによる BM25 検索
+
+    薬剤名や「トリプルネガティブ」のような専門用語は、埋め込みよりも文字の一致で拾いやすい。
+    ポスティングは CSR 形式（語ごとの文書番号と BM25 の重みを 1 本の配列に連結）で持ち、
+    検索は問い合わせの n-gram ごとにスライスを足し合わせるだけなので、数百件〜数十万件でも速い。
+    """
+
+    def __init__(self, documents, sizes=(2, 3), k1=1.2, b=0.75):
+        self.sizes = tuple(sizes)
+        self.size = len(documents)
+
+        counts = [Counter(char_ngrams(document, self.sizes)) for document in documents]
+        lengths = np.array([sum(c.values()) for c in counts], dtype=np.float32)
+        average_length = float(lengths.mean()) if self.size and lengths.sum() else 1.0
+
+        # 語 → 語番号、語ごとの (文書番号, 出現回数)
+        self.terms = {}
+        postings = []
+        for doc_id, c in enumerate(counts):
+            for term, tf in c.items():
+                term_id = self.terms.setdefault(term, len(self.terms))
+                if term_id == len(postings):
+                    postings.append([])
+                postings[term_id].append((doc_id, tf))
+
+        self.offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(p) for p in postings])
+        self.doc_ids = np.empty(self.offsets[-1], dtype=np.int32)
+        self.weights = np.empty(self.offsets[-1], dtype=np.float32)
+        for term_id, posting in enumerate(postings):
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            doc_ids = np.array([doc_id for doc_id, _ in posting], dtype=np.int32)
+            tf = np.array([tf for _, tf in posting], dtype=np.float32)
+            idf = math.log(1 + (self.size - len(posting) + 0.5) / (len(posting) + 0.5))
+            norm = k1 * (1 - b + b * lengths[doc_ids] / average_length)
+            self.doc_ids[start:end] = doc_ids
+            # 検索時は重みを足すだけで済むよう、BM25 の語ごとの値を先に計算しておく
+            self.weights[start:end] = idf * tf * (k1 + 1) / (tf + norm)
+
+    def scores(self, text):
+        """すべての文書に対する BM25 スコア（一致する n-gram がなければ 0）"""
+        slices = []
+        for term in set(char_ngrams(text, self.sizes)):
+            term_id = self.terms.get(term)
+            if term_id is not None:
+                slices.append(slice(self.offsets[term_id], self.offsets[term_id + 1]))
+        if not slices:
+            return np.zeros(self.size, dtype=np.float32)
+        # 語ごとに足し込むより、ポスティングを連結して 1 回の bincount で集計するほうが速い
+        doc_ids = np.concatenate([self.doc_ids[s] for s in slices])
+        weights = np.concatenate([self.weights[s] for s in slices])
+        return np.bincount(doc_ids, weights, minlength=self.size).astype(np.float32)
+
+    def search(self, text, k):
+        """スコアが 0 より大きい上位 k 件の (文書番号, スコア)。スコアの降順"""
+        scores = self.scores(text)
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        order = np.argsort(-scores[matched], kind="stable")
+        return matched[order], scores[matched[order]]
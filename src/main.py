@@ -47,21 +47,18 @@ line_bot_api = AsyncMessagingApi(async_api_client)
 parser = WebhookParser(channel_secret)
 
 
-def save_chat(
-    user_id,
-    messege_id,
-    user_message,
-    response_id,
-    timestamp,
-    reply_id,
-    version,
-    file_name="./data/outputs/line_chat_history.csv",
-):
-    # CSVファイルが存在しない場合は、ヘッダーを含む新しいファイルを作成
-    if not os.path.exists(file_name):
-        with open(file_name, "w", encoding="utf-8") as file:
-            writer = csv.writer(file)
-            writer.writerow(
+# 追記用に開いたままにしておく CSV ファイル（行ごとに開き直さない）
+_chat_files = {}
+
+
+def _open_chat_file(file_name):
+    file = _chat_files.get(file_name)
+    if file is None:
+        # CSVファイルが存在しない場合は、ヘッダーを含む新しいファイルを作成
+        write_header = not os.path.exists(file_name)
+        file = open(file_name, "a", encoding="utf-8", newline="")
+        if write_header:
+            csv.writer(file).writerow(
                 [
                     "user_id",
                     "messege_id",
@@ -72,21 +69,34 @@ def save_chat(
                     "version",
                 ]
             )
+        _chat_files[file_name] = file
+    return file
+
 
+def save_chat(
+    user_id,
+    messege_id,
+    user_message,
+    response_id,
+    timestamp,
+    reply_id,
+    version,
+    file_name="./data/outputs/line_chat_history.csv",
+):
     # CSVファイルにデータを追記
-    with open(file_name, "a", encoding="utf-8") as file:
-        writer = csv.writer(file)
-        writer.writerow(
-            [
-                user_id,
-                messege_id,
-                user_message,
-                response_id,
-                timestamp,
-                reply_id,
-                version,
-            ]
-        )
+    file = _open_chat_file(file_name)
+    csv.writer(file).writerow(
+        [
+            user_id,
+            messege_id,
+            user_message,
+            response_id,
+            timestamp,
+            reply_id,
+            version,
+        ]
+    )
+    file.flush()
 
 
 def generate_random_string(length):
@@ -0,0 +1,215 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+
+# 計測を行うか（0 にすると stage() は何もしない）
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# イベントごとの処理段階の時間を 1 行の JSON でログに出すか
+TRACE_LOG = os.getenv("TRACE_LOG", "0") == "1"
+
+# ヒストグラムのバケット（秒）
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+_registry = []
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    """ラベル 1 つで区別するカウンター（Prometheus の counter）"""
+
+    def __init__(self, name, documentation, label):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, label_value, amount=1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_value, value in sorted(self._values.items()):
+                lines.append(
+                    f'{self.name}{{{self.label}="{_escape(label_value)}"}} {_format_value(value)}'
+                )
+        return lines
+
+
+class Histogram:
+    """ラベル 1 つで区別するヒストグラム（Prometheus の histogram）"""
+
+    def __init__(self, name, documentation, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(buckets)
+        # ラベルの値 → [バケットごとの件数..., 合計, 件数]
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, label_value, value):
+        with self._lock:
+            values = self._values.get(label_value)
+            if values is None:
+                values = self._values[label_value] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+                    break
+            values[-2] += value
+            values[-1] += 1
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            items = [(key, list(values)) for key, values in sorted(self._values.items())]
+        for label_value, values in items:
+            label = f'{self.label}="{_escape(label_value)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(
+                    f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}'
+                )
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {values[-1]}')
+            lines.append(f"{self.name}_sum{{{label}}} {_format_value(values[-2])}")
+            lines.append(f"{self.name}_count{{{label}}} {values[-1]}")
+        return lines
+
+
+class Gauge:
+    """値を返す関数を登録しておき、出力のたびに呼び出すゲージ"""
+
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        _registry.append(self)
+
+    def render(self):
+        try:
+            value = self.function()
+        except Exception:
+            return []
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {_format_value(value)}",
+        ]
+
+
+stage_seconds = Histogram(
+    "chatbot_stage_seconds", "処理段階ごとの所要時間（秒）", "stage"
+)
+events_total = Counter("chatbot_events_total", "受信した webhook イベントの数", "type")
+errors_total = Counter("chatbot_errors_total", "処理段階ごとのエラーの数", "stage")
+# FAQ の回答キャッシュの参照結果（exact / pinned / recent / miss）。FAQ を読み直してもリセットしない
+faq_cache_lookups_total = Counter(
+    "chatbot_faq_cache_lookups_total", "FAQ の回答キャッシュの参照数（ヒットの種類・ミス）", "result"
+)
+
+# 処理中のイベントのトレース（TRACE_LOG のときだけ使う）
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+class _StageTimer:
+    __slots__ = ("name", "started_at")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started_at
+        stage_seconds.observe(self.name, elapsed)
+        if exc_type is not None:
+            errors_total.inc(self.name)
+        trace = _trace.get()
+        if trace is not None:
+            entry = (self.name, round(elapsed * 1000, 3))
+            # run_with_traces でまとめて処理している場合は、すべてのトレースに記録する
+            for t in trace if isinstance(trace, list) else (trace,):
+                t["stages"].append(entry)
+        return False
+
+
+_NULL_TIMER = nullcontext()
+
+
+def stage(name):
+    """with stage("encode"): のように使い、ブロックの所要時間を記録する"""
+    if not METRICS_ENABLED:
+        return _NULL_TIMER
+    return _StageTimer(name)
+
+
+def observe(name, seconds):
+    # with で囲めない区間（キューの待ち時間など）の時間を記録する
+    if METRICS_ENABLED:
+        stage_seconds.observe(name, seconds)
+
+
+def start_trace(**fields):
+    """このタスクで行う処理段階の時間を集める（TRACE_LOG が無効なら None を返す）"""
+    if not TRACE_LOG:
+        return None
+    trace = dict(fields, stages=[], started_at=time.perf_counter())
+    return _trace.set(trace)
+
+
+def current_trace():
+    """このタスクのトレース（ほかのスレッドで行う処理に引き継ぐときに使う）"""
+    return _trace.get()
+
+
+def run_with_traces(traces, function, *args):
+    """traces のすべてに処理段階の時間を記録しながら function を実行する
+
+    マイクロバッチのように複数のイベントの処理をまとめてスレッドで行う場合に使う。
+    contextvars.copy_context().run の中で呼び、ほかの処理にトレースを残さないこと。
+    """
+    traces = [trace for trace in traces if trace is not None]
+    _trace.set(traces or None)
+    return function(*args)
+
+
+def finish_trace(token):
+    """start_trace で集めた処理段階の時間を 1 行の JSON で出力する"""
+    if token is None:
+        return
+    trace = _trace.get()
+    _trace.reset(token)
+    trace["total_ms"] = round((time.perf_counter() - trace.pop("started_at")) * 1000, 3)
+    print("trace " + json.dumps(trace, ensure_ascii=False))
+
+
+def render():
+    """Prometheus のテキスト形式で出力する"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,48 @@
+import unicodedata
+
+
+# 質問ではない短いメッセージ（normalize_text 後の文字列と比較する）
+# 「はい」「いいえ」などボタンで送られる文字列は、ステップの処理やクイックリプライの選択肢と
+# 重なるので含めない
+GREETINGS = {
+    "こんにちは",
+    "こんばんは",
+    "おはよう",
+    "おはようございます",
+    "はじめまして",
+    "ありがとう",
+    "ありがとうございます",
+    "ありがとうございました",
+    "よろしく",
+    "よろしくお願いします",
+    "よろしくおねがいします",
+    "了解",
+    "了解です",
+    "わかりました",
+    "分かりました",
+}
+
+# 検索を行わずに返す定型文（理由ごと）
+FALLBACK_MESSAGES = {
+    "greeting": "乳がんに関して知りたいことがありましたら、質問を入力してください。",
+    "not_a_question": "ご質問の内容がわかりませんでした。乳がんに関して知りたいことを文章で入力してください。",
+    "low_score": "申し訳ありません。ご質問に合う情報が見つかりませんでした。別の言葉で質問してみてください。",
+}
+
+
+def prefilter(key, min_length=2):
+    """モデルに通すまでもない入力なら定型文の理由を、そうでなければ None を返す
+
+    key は normalize_text 後の文字列。
+    - 挨拶・相づち → "greeting"
+    - 文字を含まない（絵文字・記号のみ）、数字のみ（研究 ID など）、短すぎる → "not_a_question"
+    """
+    # 句読点・記号・絵文字を除いた部分で判定する（「こんにちは！」も挨拶として扱う）
+    text = "".join(char for char in key if unicodedata.category(char)[0] not in "PS")
+    if text in GREETINGS:
+        return "greeting"
+    if len(key) < min_length or text.isdigit():
+        return "not_a_question"
+    if not any(unicodedata.category(char)[0] == "L" for char in text):
+        return "not_a_question"
+    return None
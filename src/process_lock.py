@@ -0,0 +1,56 @@
+import fcntl
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def file_lock(path):
+    """ファイルロック（flock）を取得している間だけ処理を行う
+
+    同じホストの複数のワーカープロセスで、DB の初期化やインデックスの作成が
+    同時に行われないようにする。プロセスが落ちた場合、ロックは OS が解放する。
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class LeaderLock:
+    """ワーカープロセスのうち 1 つだけをリーダーにするためのファイルロック
+
+    try_acquire() でロックを取れたプロセスがリーダーになり、終了するまで保持する。
+    リーダーのプロセスが落ちるとロックが解放されるので、ほかのプロセスが
+    定期的に try_acquire() を呼んでいれば引き継がれる。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    @property
+    def is_leader(self):
+        return self._file is not None
+
+    def try_acquire(self):
+        """ロックを取得できれば（すでに保持していれば）True を返す。待たない"""
+        if self._file is not None:
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        f = open(self.path, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
@@ -0,0 +1,132 @@
+import asyncio
+import os
+import random
+
+import httpx
+
+from src.metrics import stage
+from src.utils import LINE_API_BASE_URL, channel_access_token, get_http_client
+
+
+# 同時に送信中にするリクエストの上限
+PUSH_CONCURRENCY = int(os.getenv("PUSH_CONCURRENCY", "50"))
+# 1 秒あたりのリクエスト数の上限（LINE の push / multicast は 2,000 req/s まで）
+PUSH_RATE_LIMIT = float(os.getenv("PUSH_RATE_LIMIT", "2000"))
+# 429 / 5xx / 通信エラー時の再試行回数
+PUSH_MAX_RETRIES = int(os.getenv("PUSH_MAX_RETRIES", "5"))
+
+
+class TokenBucket:
+    """1 秒あたり rate 回までに呼び出しを制限する（同じイベントループ内で使う）"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate / 10)
+        self.tokens = self.capacity
+        self.updated_at = None
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self.updated_at is not None:
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated_at) * self.rate
+                )
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class PushDispatcher:
+    """LINE の push / multicast を非同期に並行送信する
+
+    - 同時送信数を concurrency までに制限し、トークンバケットでリクエスト数/秒を制限する
+    - 429・5xx・通信エラーは指数バックオフ（Retry-After があればそれに従う）で再試行する
+    - retry_key を X-Line-Retry-Key に付けるので、同じキーでの再送は LINE 側で重複が排除される
+      （すでに受け付けられていれば 409 が返るので、送信済みとして扱う）
+    """
+
+    def __init__(
+        self,
+        client=None,
+        access_token=channel_access_token,
+        base_url=LINE_API_BASE_URL,
+        concurrency=PUSH_CONCURRENCY,
+        rate_limit=PUSH_RATE_LIMIT,
+        max_retries=PUSH_MAX_RETRIES,
+        backoff_base=0.5,
+        backoff_max=30.0,
+    ):
+        # 指定がなければアプリ全体で共有する HTTP クライアントを使う
+        self.client = client if client is not None else get_http_client()
+        self.access_token = access_token
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bucket = TokenBucket(rate_limit)
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+
+    async def push(self, to, messages, retry_key=None):
+        """1 人のユーザーにメッセージ（最大 5 件の dict）を送る。送信できたら True"""
+        return await self._post(
+            "/v2/bot/message/push", {"to": to, "messages": messages}, retry_key
+        )
+
+    async def multicast(self, to, messages, retry_key=None):
+        """最大 500 人のユーザーに同じメッセージを送る。送信できたら True"""
+        return await self._post(
+            "/v2/bot/message/multicast", {"to": list(to), "messages": messages}, retry_key
+        )
+
+    async def _post(self, path, payload, retry_key):
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        if retry_key is not None:
+            headers["X-Line-Retry-Key"] = retry_key
+
+        for attempt in range(self.max_retries + 1):
+            response = None
+            async with self._semaphore:
+                await self._bucket.acquire()
+                self.requests += 1
+                try:
+                    with stage("reminder_push"):
+                        response = await self.client.post(
+                            self.base_url + path, json=payload, headers=headers
+                        )
+                except httpx.TransportError as e:
+                    error = repr(e)
+
+            if response is not None:
+                if response.status_code == 200:
+                    return True
+                if response.status_code == 409 and retry_key is not None:
+                    # 同じ retry_key のリクエストはすでに受け付けられている
+                    return True
+                error = f"{response.status_code} {response.text}"
+                if response.status_code != 429 and response.status_code < 500:
+                    break
+
+            if attempt == self.max_retries:
+                break
+            self.retries += 1
+            await asyncio.sleep(self._backoff(attempt, response))
+
+        self.failures += 1
+        print(f"push failed: {path} {error}")
+        return False
+
+    def _backoff(self, attempt, response):
+        if response is not None and "Retry-After" in response.headers:
+            try:
+                return float(response.headers["Retry-After"])
+            except ValueError:
+                pass
+        delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+        return delay * random.uniform(0.5, 1.0)
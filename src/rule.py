@@ -1,14 +1,18 @@
+import time
+
+# 起動から最初の webhook を受け付けるまでの時間を計測する
+STARTED_AT = time.perf_counter()
+
+import asyncio
+import hmac
 import os
 import sys
-import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from linebot.exceptions import InvalidSignatureError
 from linebot.v3.webhook import WebhookParser
 from linebot.v3.messaging import (
-    AsyncApiClient,
-    AsyncMessagingApi,
-    Configuration,
     ReplyMessageRequest,
     TextMessage,
     QuickReply,
@@ -19,21 +23,47 @@ from linebot.v3.messaging import (
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from src.find_answer import find_option
+from src.chat_log import chat_log_writer
+from src.event_queue import UserEventQueue
+from src.metrics import (
+    Gauge,
+    events_total,
+    finish_trace,
+    render as render_metrics,
+    stage,
+    start_trace,
+)
+from src.process_lock import LeaderLock
+from src.find_answer import (
+    FAQ_WATCH_INTERVAL,
+    afind_option,
+    aload_faq_service,
+    areload_faq_service,
+    faq_cache_stats,
+    faq_reload_status,
+    is_ready,
+    watch_faq_data,
+)
 from src.utils import (
+    close_connections,
+    close_http_client,
+    open_http_client,
+    push_message,
+    reply_message,
     get_jst_now,
     get_user_state,
     update_user_state,
-    save_message_to_db,
+    user_state_cache,
+    REMINDER_HOUR,
     generate_random_string,
     reply,
     send_confirm_message,
     confirm_callback,
     start_loading_animation,
 )
-from src.send_reminders import check_reminders
+from src.send_reminders import check_reminders_async
 
 
 load_dotenv()
@@ -48,21 +78,172 @@ if channel_access_token is None:
     print("Specify LINE_CHANNEL_ACCESS_TOKEN as environment variable.")
     sys.exit(1)
 
-configuration = Configuration(access_token=channel_access_token)
+JST = timezone(timedelta(hours=9))
+# リマインダーの送信を担当するプロセスを決めるロックファイル
+SCHEDULER_LOCK_PATH = os.getenv(
+    "SCHEDULER_LOCK_PATH", "./data/outputs/scheduler.lock"
+)
+# リーダーでないワーカーがロックの取得を試みる間隔（秒）
+SCHEDULER_ELECTION_INTERVAL = float(os.getenv("SCHEDULER_ELECTION_INTERVAL", "30"))
+# 送信に失敗したリマインダーを送り直すまでの秒数（retry_key が有効な約 24 時間のうちに送り直す）
+REMINDER_CATCH_UP_DELAY = float(os.getenv("REMINDER_CATCH_UP_DELAY", "600"))
+
+# 複数ワーカーで動かしても、リマインダーを送るのはロックを持つ 1 プロセスだけ
+scheduler_leader = LeaderLock(SCHEDULER_LOCK_PATH)
+
+
+# 送信ジョブと送り直しが重ならないようにする（同じリマインダーに別の retry_key を割り当てない）
+_reminder_lock = None
+
+
+def elect_scheduler_leader():
+    if not scheduler_leader.is_leader and scheduler_leader.try_acquire():
+        print(f"scheduler leader: pid {os.getpid()}")
+        # 前のリーダーが送信の途中で止まった場合に備え、直近の送信ジョブの分を確認する
+        schedule_reminder_catch_up(0)
+
+
+def schedule_reminder_catch_up(delay):
+    scheduler.add_job(
+        check_reminders_if_leader,
+        "date",
+        run_date=datetime.now(JST) + timedelta(seconds=delay),
+        kwargs={"catch_up": True},
+        id="reminder_catch_up",
+        replace_existing=True,
+        # 起動前に登録した場合も、起動後に必ず実行する
+        misfire_grace_time=None,
+    )
+
+
+async def check_reminders_if_leader(catch_up=False):
+    global _reminder_lock
+    if not scheduler_leader.is_leader:
+        return
+    if _reminder_lock is None:
+        _reminder_lock = asyncio.Lock()
+    async with _reminder_lock:
+        try:
+            complete = await check_reminders_async(catch_up=catch_up)
+        except Exception as e:
+            print(f"reminder check failed: {e!r}")
+            complete = False
+    if not complete:
+        # 失敗したまとまりは、キーの有効期限内に同じ retry_key で送り直す
+        schedule_reminder_catch_up(REMINDER_CATCH_UP_DELAY)
+
+
+# リマインダーの送信はアプリのイベントループ上で非同期に行う
+scheduler = AsyncIOScheduler(timezone=JST)
+scheduler.add_job(
+    check_reminders_if_leader, "cron", hour=REMINDER_HOUR, minute=0, second=0, timezone=JST
+)
+# リーダーのプロセスが落ちた場合は、ほかのワーカーが引き継ぐ
+scheduler.add_job(
+    elect_scheduler_leader, "interval", seconds=SCHEDULER_ELECTION_INTERVAL
+)
+
+# 管理用エンドポイントのトークン（未設定なら管理用エンドポイントは使えない）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", None)
+# 完了を待たずに実行しているタスク（ガベージコレクションされないよう参照を持つ）
+background_tasks = set()
+
+# 起動時間の計測結果（秒）
+startup_timings = {"first_webhook": None, "faq_ready": None}
+
+
+async def warm_up_faq_service():
+    """FAQ 検索（モデル・インデックス）をバックグラウンドで読み込む"""
+    try:
+        await aload_faq_service()
+    except Exception as e:
+        print(f"FAQ warm-up failed: {e!r}")
+        return
+    startup_timings["faq_ready"] = time.perf_counter() - STARTED_AT
+    print(f"FAQ service ready: {startup_timings['faq_ready']:.3f}s after start")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # 重い検索スタックの読み込みを待たずに webhook の受け付けを開始する
+    warm_up_task = asyncio.create_task(warm_up_faq_service())
+    watch_task = None
+    if FAQ_WATCH_INTERVAL > 0:
+        watch_task = asyncio.create_task(watch_faq_data())
+    # LINE API への接続はプロセス全体で 1 つのクライアント（接続プール）を使い回す
+    open_http_client()
+    chat_log_writer.start()
+    elect_scheduler_leader()
+    scheduler.start()
+    yield
+    scheduler.shutdown(wait=False)
+    scheduler_leader.release()
+    # 受け付け済みのイベントを処理し終えてから、ログ・HTTP クライアント・DB を閉じる
+    await event_queue.stop()
+    warm_up_task.cancel()
+    if watch_task is not None:
+        watch_task.cancel()
+    # 未書き込みのログをすべて書き込んでから DB を閉じる
+    await chat_log_writer.stop()
+    await close_http_client()
+    close_connections()
+
 
-app = FastAPI()
-async_api_client = AsyncApiClient(configuration)
-line_bot_api = AsyncMessagingApi(async_api_client)
+app = FastAPI(lifespan=lifespan)
 parser = WebhookParser(channel_secret)
 
-JST = timezone(timedelta(hours=9))
-scheduler = BackgroundScheduler()
-scheduler.add_job(check_reminders, "cron", hour=12, minute=0, second=0, timezone=JST)
-scheduler.start()
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+async def ready():
+    # FAQ 検索の準備ができるまでは 503 を返す
+    body = {"ready": is_ready(), "startup_seconds": startup_timings}
+    return JSONResponse(body, status_code=200 if is_ready() else 503)
+
+
+@app.get("/stats")
+async def stats():
+    # イベントキューの滞留数・処理までの遅延（秒）とログの書き込み待ちの件数
+    return {
+        "events": event_queue.stats(),
+        "chat_log_queue_depth": chat_log_writer.queue_depth(),
+        "user_state_cache": user_state_cache.stats(),
+        "faq_cache": faq_cache_stats(),
+        "faq_reload": faq_reload_status,
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus のテキスト形式（値はこのワーカーのもの）
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/admin/reload-faq")
+async def reload_faq(request: Request):
+    # FAQ のデータセットを読み直す（このワーカーのみ。全ワーカーには FAQ_WATCH_INTERVAL を使う）
+    token = request.headers.get("X-Admin-Token", "")
+    if ADMIN_TOKEN is None or not hmac.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    # 読み直しはバックグラウンドで行い、完了を待たずに返す（状況は /stats で確認する）
+    task = asyncio.create_task(areload_faq_service())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return JSONResponse({"status": "reloading"}, status_code=202)
 
 
 @app.post("/callback")
 async def handle_callback(request: Request):
+    if startup_timings["first_webhook"] is None:
+        startup_timings["first_webhook"] = time.perf_counter() - STARTED_AT
+        print(
+            f"first webhook accepted: {startup_timings['first_webhook']:.3f}s after start"
+        )
+
     signature = request.headers["X-Line-Signature"]
 
     # get request body as text
@@ -74,168 +255,219 @@ async def handle_callback(request: Request):
     except InvalidSignatureError:
         raise HTTPException(status_code=400, detail="Invalid signature")
 
+    # 署名の検証が済んだらキューに積むだけで、すぐに 200 を返す
+    # （返信・DB の更新はバックグラウンドでユーザーごとに順番に行う）
     for event in events:
-        user_id = event.source.user_id
+        event_queue.submit(event.source.user_id, event)
+    return "OK"
+
+
+async def handle_event(event):
+    """webhook のイベントを 1 件処理する（同じユーザーのイベントは届いた順に呼ばれる）"""
+    events_total.inc(event.type)
+    trace = start_trace(type=event.type, user_id=event.source.user_id)
+    try:
+        with stage("handle_event"):
+            await _handle_event(event)
+    finally:
+        finish_trace(trace)
+
+
+async def _handle_event(event):
+    user_id = event.source.user_id
+    with stage("get_user_state"):
         step, research_id, last_question = get_user_state(user_id)
 
-        jst_dt = get_jst_now(event)
+    jst_dt = get_jst_now(event)
 
-        # follow・ブロック解除イベントの処理
-        # **ステップ 0: 初回メッセージ**
-        # 導入文・研究IDの入力の依頼
-        if event.type == "follow":
-            # update_user_state(user_id, 0)
-            time.sleep(0.5)
-            messages = [
-                # "初めまして！私の名前はBRECOBOTです。お友達登録していただきありがとうございます。",
-                # "これから一か月間、あなたが知りたいことの答えを探すお手伝いをさせていただきます。",
-                "ではさっそく、あなたの研究IDを教えてください。",
-            ]
-            await line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=message) for message in messages],
-                )
+    # follow・ブロック解除イベントの処理
+    # **ステップ 0: 初回メッセージ**
+    # 導入文・研究IDの入力の依頼
+    if event.type == "follow":
+        # update_user_state(user_id, 0)
+        await asyncio.sleep(0.5)
+        messages = [
+            # "初めまして！私の名前はBRECOBOTです。お友達登録していただきありがとうございます。",
+            # "これから一か月間、あなたが知りたいことの答えを探すお手伝いをさせていただきます。",
+            "ではさっそく、あなたの研究IDを教えてください。",
+        ]
+        await reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=message) for message in messages],
             )
-            update_user_state(user_id, 1, None, None, jst_dt)
+        )
+        update_user_state(user_id, 1, None, None, jst_dt)
 
-        if not isinstance(event, MessageEvent):
-            continue
-        if not isinstance(event.message, TextMessageContent):
-            continue
-        user_message = event.message.text.strip()
+    if not isinstance(event, MessageEvent):
+        return
+    if not isinstance(event.message, TextMessageContent):
+        return
+    user_message = event.message.text.strip()
 
-        # 使用前アンケート回答への依頼
-        if step == 1:
-            message = f"""{user_message}さんですね。私に質問をする前に下記のURLにアクセスし、アンケートにお答えください。\nhttp:// …\n（回答の際に研究IDが必要です）
+    # 使用前アンケート回答への依頼
+    if step == 1:
+        message = f"""{user_message}さんですね。私に質問をする前に下記のURLにアクセスし、アンケートにお答えください。\nhttp:// …\n（回答の際に研究IDが必要です）
     """
-            # await start_loading_animation(user_id)
-            # await reply(event, message)
-            await line_bot_api.reply_message(
+        # await start_loading_animation(user_id)
+        # await reply(event, message)
+        await reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token, messages=[TextMessage(text=message)]
+            )
+        )
+        await send_confirm_message(user_id)
+        update_user_state(user_id, 2, user_message, None, jst_dt)
+
+    # 本入力の依頼
+    if step == 2:
+        # await confirm_callback(user_message)
+        if user_message == "はい":
+            message = "入力ありがとうございました。乳がんに関して知りたいこと（知りたかったこと）を入力してください。「がん情報サービス」「乳がん診療ガイドライン」から情報を提供します。"
+            update_user_state(user_id, 3)
+            await reply_message(
                 ReplyMessageRequest(
-                    reply_token=event.reply_token, messages=[TextMessage(text=message)]
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=message)],
                 )
             )
-            send_confirm_message(user_id)
-            update_user_state(user_id, 2, user_message, None, jst_dt)
-
-        # 本入力の依頼
-        if step == 2:
-            # await confirm_callback(user_message)
-            if user_message == "はい":
-                message = "入力ありがとうございました。乳がんに関して知りたいこと（知りたかったこと）を入力してください。「がん情報サービス」「乳がん診療ガイドライン」から情報を提供します。"
-                update_user_state(user_id, 3)
-                await line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=message)],
-                    )
-                )
-            else:
-                message = f"""{research_id}さんですね。私に質問をする前に下記のURLにアクセスし、アンケートにお答えください。\nhttp:// …\n（回答の際に研究IDが必要です）
+        else:
+            message = f"""{research_id}さんですね。私に質問をする前に下記のURLにアクセスし、アンケートにお答えください。\nhttp:// …\n（回答の際に研究IDが必要です）
                         """
-                await line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=message)],
-                    )
+            await reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=message)],
                 )
-                # 使用前アンケート回答の確認
-                send_confirm_message(user_id)
-                update_user_state(user_id, 2)
-
-        # 質問の回答
-        if step >= 3 and step < 5:
-            answer, option, again_user_choice, index = find_option(user_message)
-            if option != "" or option is None:
-                quick_reply_items = []
-                for opt, choice in zip(option, again_user_choice):
-                    quick_reply_items.append(
-                        QuickReplyItem(action=MessageAction(label=opt, text=choice))
-                    )
-                quick_reply = QuickReply(items=quick_reply_items)
-                replymessease = await line_bot_api.reply_message(
+            )
+            # 使用前アンケート回答の確認
+            await send_confirm_message(user_id)
+            update_user_state(user_id, 2)
+
+    # 質問の回答
+    if step >= 3 and step < 5:
+        answer, option, again_user_choice, index = await afind_option(
+            user_message
+        )
+        if option != "" or option is None:
+            quick_reply_items = []
+            for opt, choice in zip(option, again_user_choice):
+                quick_reply_items.append(
+                    QuickReplyItem(action=MessageAction(label=opt, text=choice))
+                )
+            quick_reply = QuickReply(items=quick_reply_items)
+            replymessease = await reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=answer[0], quick_reply=quick_reply)],
+                )
+            )
+            reply_id = generate_random_string(10)
+            again_user_choice = [reply_id] + again_user_choice
+            again_user_choice = "\t".join(again_user_choice)
+            update_user_state(user_id, step, None, again_user_choice)
+
+        else:
+            if len(answer) > 5:
+                # 1回目のリプライ (5件まで)
+                await reply_message(
                     ReplyMessageRequest(
                         reply_token=event.reply_token,
-                        messages=[TextMessage(text=answer[0], quick_reply=quick_reply)],
+                        messages=[TextMessage(text=ans) for ans in answer[:5]],
                     )
                 )
-                reply_id = generate_random_string(10)
-                again_user_choice = [reply_id] + again_user_choice
-                again_user_choice = "\t".join(again_user_choice)
-                update_user_state(user_id, step, None, again_user_choice)
-
-            else:
-                if len(answer) > 5:
-                    # 1回目のリプライ (5件まで)
-                    await line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=ans) for ans in answer[:5]],
-                        )
-                    )
 
-                    # 残りのメッセージは push_message で送信
-                    for i in range(5, len(answer), 5):
-                        await line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=event.source.user_id,
-                                messages=[
-                                    TextMessage(text=ans) for ans in answer[i : i + 5]
-                                ],
-                            )
-                        )
-                else:
-                    await line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=ans) for ans in answer],
+                # 残りのメッセージは push_message で送信
+                for i in range(5, len(answer), 5):
+                    await push_message(
+                        PushMessageRequest(
+                            to=event.source.user_id,
+                            messages=[
+                                TextMessage(text=ans) for ans in answer[i : i + 5]
+                            ],
                         )
                     )
-                if last_question:
-                    last_question = last_question.split("\t")
-                    reply_id = last_question[0]
-                    again_user_choice = last_question[1:]
-                    if user_message not in again_user_choice:
-                        reply_id = ""
-                    update_user_state(user_id, step)
-                else:
-                    reply_id = ""
-
-            save_message_to_db(
-                user_id,
-                event.message.id,
-                user_message,
-                str(index),
-                reply_id,
-                jst_dt,
-                version="sample",
-            )
-
-        if step == 5:
-            if user_message == "はい":
-                messages = [
-                    "ご入力ありがとうございました。これにて私、BRECOBOTのご利用は終了とさせていただきます。インタビュー調査に参加してくださる方には、後ほど個別に研究者より連絡が参りますので、もうしばらくお待ちください。",
-                    "ご意見などがございましたら、研究事務局までお気軽にご連絡ください。\nncc-ganchatbot＠ml.res.ncc.go.jp",
-                    "ご協力ありがとうございました。",
-                ]
-                await line_bot_api.reply_message(
+            else:
+                await reply_message(
                     ReplyMessageRequest(
                         reply_token=event.reply_token,
-                        messages=[TextMessage(text=m) for m in messages],
+                        messages=[TextMessage(text=ans) for ans in answer],
                     )
                 )
-                update_user_state(user_id, 10)
+            if last_question:
+                last_question = last_question.split("\t")
+                reply_id = last_question[0]
+                again_user_choice = last_question[1:]
+                if user_message not in again_user_choice:
+                    reply_id = ""
+                update_user_state(user_id, step)
             else:
-                messages = [
-                    """本日で利用期間が終了です。ご利用ありがとうございました。最後に、下記のURLにアクセスし、アンケートにお答えください。\nhttp:// …\n（回答の際に研究IDが必要です）""",
-                    "また、さらに詳しいご感想を聞かせていただきたく、インタビュー調査も予定しています。ご協力くださる方は、アンケートの最後の同意確認欄と、個人情報をご入力ください。",
-                ]
-                await line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=message) for message in messages],
-                    )
+                reply_id = ""
+
+        # ログはキューに積むだけで、書き込みはバックグラウンドで行う
+        await chat_log_writer.write(
+            user_id,
+            event.message.id,
+            user_message,
+            str(index),
+            reply_id,
+            jst_dt,
+            version="sample",
+        )
+
+    if step == 5:
+        if user_message == "はい":
+            messages = [
+                "ご入力ありがとうございました。これにて私、BRECOBOTのご利用は終了とさせていただきます。インタビュー調査に参加してくださる方には、後ほど個別に研究者より連絡が参りますので、もうしばらくお待ちください。",
+                "ご意見などがございましたら、研究事務局までお気軽にご連絡ください。\nncc-ganchatbot＠ml.res.ncc.go.jp",
+                "ご協力ありがとうございました。",
+            ]
+            await reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=m) for m in messages],
                 )
-                send_confirm_message(user_id)
-    return "OK"
+            )
+            update_user_state(user_id, 10)
+        else:
+            messages = [
+                """本日で利用期間が終了です。ご利用ありがとうございました。最後に、下記のURLにアクセスし、アンケートにお答えください。\nhttp:// …\n（回答の際に研究IDが必要です）""",
+                "また、さらに詳しいご感想を聞かせていただきたく、インタビュー調査も予定しています。ご協力くださる方は、アンケートの最後の同意確認欄と、個人情報をご入力ください。",
+            ]
+            await reply_message(
+                ReplyMessageRequest(
+                    reply_token=event.reply_token,
+                    messages=[TextMessage(text=message) for message in messages],
+                )
+            )
+            await send_confirm_message(user_id)
+
+
+event_queue = UserEventQueue(handle_event)
+
+Gauge("chatbot_event_queue_depth", "処理待ちの webhook イベントの数", lambda: event_queue.depth)
+Gauge(
+    "chatbot_chat_log_queue_depth",
+    "書き込み待ちのチャットログの数",
+    chat_log_writer.queue_depth,
+)
+Gauge(
+    "chatbot_user_state_cache_hit_ratio",
+    "ユーザー状態のキャッシュのヒット率",
+    lambda: user_state_cache.stats()["hit_rate"],
+)
+Gauge("chatbot_faq_ready", "FAQ 検索の準備ができていれば 1", lambda: int(is_ready()))
+
+
+def _faq_cache_size():
+    stats = faq_cache_stats()
+    if stats is None:
+        return 0
+    return stats["recent_size"] + stats["pinned_size"]
+
+
+Gauge(
+    "chatbot_faq_cache_size",
+    "FAQ の回答キャッシュに保持している件数（最近の入力とクイックリプライ）",
+    _faq_cache_size,
+)
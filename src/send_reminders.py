@@ -1,183 +1,262 @@
-import os
-import sqlite3
+import asyncio
 import datetime
+import json
+import os
+import uuid
+from itertools import groupby
+
 import pytz
-from linebot import LineBotApi
-from linebot.models import TextSendMessage
-from apscheduler.schedulers.background import BackgroundScheduler
-from dotenv import load_dotenv
-from src.utils import send_confirm_message, update_user_state
+from src.metrics import stage
+from src.push_dispatcher import PushDispatcher
+from src.utils import (
+    CONFIRM_MESSAGE,
+    REMINDER_OFFSETS,
+    REMINDER_TIME_FORMAT,
+    close_http_client,
+    get_connection,
+    last_reminder_run,
+    update_user_states,
+)
 
-DB_PATH = "./data/outputs/chatbot.db"
-LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
+CHECK_IN_MESSAGE = "調子はいかがですか？何か乳がんについて知りたいことがありましたら私までお気軽におたずねください。"
+AFTER_USE_ENDS_MESSAGES = [
+    """本日で利用期間が終了です。ご利用ありがとうございました。最後に、下記のURLにアクセスし、アンケートにお答えください。\nhttp:// …\n（回答の際に研究IDが必要です）
+    """,
+    "また、さらに詳しいご感想を聞かせていただきたく、インタビュー調査も予定しています。ご協力くださる方は、アンケートの最後の同意確認欄と、個人情報をご入力ください。",
+]
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
 
+def _text_messages(texts):
+    return [{"type": "text", "text": text} for text in texts]
 
-def check_reminders():
-    """リマインダーを確認し、送信する"""
-    now = datetime.datetime.now(pytz.timezone("Asia/Tokyo"))
-    one_day_ago = now - datetime.timedelta(days=1)
-
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-
-        # 3日後リマインダーの送信
-        cursor.execute(
-            "SELECT user_id FROM user_state WHERE reminder_3days BETWEEN ? AND ?",
-            (
-                one_day_ago.strftime("%Y-%m-%d %H:%M:%S"),
-                now.strftime("%Y-%m-%d %H:%M:%S"),
-            ),
-        )
-        users_3days = cursor.fetchall()
-
-        for user in users_3days:
-            user_id = user[0]
-            line_bot_api.push_message(
-                user_id,
-                TextSendMessage(
-                    text="調子はいかがですか？何か乳がんについて知りたいことがありましたら私までお気軽におたずねください。"
-                ),
-            )
-            print("3日後リマインダーの送信")
-            update_user_state(user_id, 4.3)
-
-        # 1週間後リマインダーの送信
-        cursor.execute(
-            "SELECT user_id FROM user_state WHERE reminder_7days BETWEEN ? AND ?",
-            (
-                one_day_ago.strftime("%Y-%m-%d %H:%M:%S"),
-                now.strftime("%Y-%m-%d %H:%M:%S"),
-            ),
-        )
-        users_7days = cursor.fetchall()
-
-        for user in users_7days:
-            user_id = user[0]
-            line_bot_api.push_message(
-                user_id,
-                TextSendMessage(
-                    text="調子はいかがですか？何か乳がんについて知りたいことがありましたら私までお気軽におたずねください。"
-                ),
-            )
-            print("1週間後リマインダーの送信")
-            update_user_state(user_id, 4.7)
-
-        # 2週間後リマインダーの送信
-        cursor.execute(
-            "SELECT user_id FROM user_state WHERE reminder_14days BETWEEN ? AND ?",
-            (
-                one_day_ago.strftime("%Y-%m-%d %H:%M:%S"),
-                now.strftime("%Y-%m-%d %H:%M:%S"),
-            ),
-        )
-        users_14days = cursor.fetchall()
-
-        for user in users_14days:
-            user_id = user[0]
-            line_bot_api.push_message(
-                user_id,
-                TextSendMessage(
-                    text="調子はいかがですか？何か乳がんについて知りたいことがありましたら私までお気軽におたずねください。"
-                ),
-            )
-            print("2週間後リマインダーの送信")
-            update_user_state(user_id, 4.14)
-
-        # 3週間後リマインダーの送信
-        cursor.execute(
-            "SELECT user_id FROM user_state WHERE reminder_21days BETWEEN ? AND ?",
-            (
-                one_day_ago.strftime("%Y-%m-%d %H:%M:%S"),
-                now.strftime("%Y-%m-%d %H:%M:%S"),
-            ),
-        )
-        users_21days = cursor.fetchall()
-
-        for user in users_21days:
-            user_id = user[0]
-            line_bot_api.push_message(
-                user_id,
-                TextSendMessage(
-                    text="調子はいかがですか？何か乳がんについて知りたいことがありましたら私までお気軽におたずねください。"
-                ),
-            )
-            print("3週間後リマインダーの送信")
-            update_user_state(user_id, 4.21)
-
-        # 利用日の前日リマインダーの送信
-        cursor.execute(
-            "SELECT user_id FROM user_state WHERE before_the_last_day BETWEEN ? AND ?",
-            (
-                one_day_ago.strftime("%Y-%m-%d %H:%M:%S"),
-                now.strftime("%Y-%m-%d %H:%M:%S"),
-            ),
-        )
-        users_before_the_last_day = cursor.fetchall()
 
-        for user in users_before_the_last_day:
-            user_id = user[0]
-            line_bot_api.push_message(
-                user_id,
-                TextSendMessage(text="明日で私のお手伝いできる期間が終了します。"),
+# リマインダーの種類ごとの (送信後の step, メッセージ, ログ)
+# メッセージを user_id を受け取る関数にすると、ユーザーごとに個別の内容を送れる（個別に push する）
+REMINDERS = {
+    "reminder_3days": (
+        4.3,
+        _text_messages([CHECK_IN_MESSAGE]),
+        "3日後リマインダーの送信",
+    ),
+    "reminder_7days": (
+        4.7,
+        _text_messages([CHECK_IN_MESSAGE]),
+        "1週間後リマインダーの送信",
+    ),
+    "reminder_14days": (
+        4.14,
+        _text_messages([CHECK_IN_MESSAGE]),
+        "2週間後リマインダーの送信",
+    ),
+    "reminder_21days": (
+        4.21,
+        _text_messages([CHECK_IN_MESSAGE]),
+        "3週間後リマインダーの送信",
+    ),
+    "before_the_last_day": (
+        4.9,
+        _text_messages(["明日で私のお手伝いできる期間が終了します。"]),
+        "利用日の前日リマインダーの送信",
+    ),
+    # アンケートの確認メッセージも同じリクエストで送る（1 回の送信で完結させる）
+    "after_use_ends": (
+        5,
+        _text_messages(AFTER_USE_ENDS_MESSAGES) + [CONFIRM_MESSAGE],
+        "利用終了日1ヶ月後リマインダーの送信",
+    ),
+}
+# 同じユーザーに複数のリマインダーが届く場合は、この順に送信する（最後の step が残る）
+REMINDER_ORDER = {kind: i for i, (kind, _) in enumerate(REMINDER_OFFSETS)}
+# multicast 1 回あたりの宛先の上限
+MULTICAST_MAX_RECIPIENTS = 500
+# 送信日時からこの日数を過ぎた未送信のリマインダーは送らない（0 なら制限しない）
+# 止まっていた間のリマインダーをまとめて送ったり、「明日で終了」を数日遅れて送ったりしないよう、
+# 既定では毎日の実行の間隔（1 日）に収まるものだけを送る。送信に失敗したものや途中で止まったものは、
+# この期間内の次の実行で送り直す
+REMINDER_MAX_AGE_DAYS = float(os.getenv("REMINDER_MAX_AGE_DAYS", "1"))
+# LINE が X-Line-Retry-Key を覚えている時間（約 24 時間）より短く取った、キーを使い回せる時間
+# これを過ぎたキーで送り直すと重複が排除されず二重に届きうるので、そのリマインダーは送らない
+REMINDER_RETRY_KEY_TTL_HOURS = float(os.getenv("REMINDER_RETRY_KEY_TTL_HOURS", "23"))
+
+
+def reminder_messages(kind, user_id):
+    messages = REMINDERS[kind][1]
+    return messages(user_id) if callable(messages) else messages
+
+
+def prepare_due_reminders(now, max_age_days=REMINDER_MAX_AGE_DAYS, due_until=None):
+    """due_until（省略時は now）までに送信日時が来た未送信のリマインダーを、送信単位にまとめて返す
+
+    前回までに送信できなかったものも含む（max_age_days が正なら、due_until からそれより古いものは除く）。
+    割り当て済みの retry_key が REMINDER_RETRY_KEY_TTL_HOURS より古いものは、送信済みかどうか
+    わからないので除く（未送信のまま残す）。
+
+    同じ種類で同じ内容のメッセージを受け取るユーザーを最大 500 人ずつまとめ、
+    まとまりごとに retry_key を割り当てて保存してから返す。送信の途中でプロセスが落ちても、
+    再実行時は同じまとまりを同じキーで送るので二重に届かない。
+
+    返り値は (kind, messages, retry_key, [(reminder_id, user_id), ...]) のリスト。
+    """
+    if due_until is None:
+        due_until = now
+    conn = get_connection()
+    # 未送信のものだけの部分インデックス（idx_reminders_pending_due_at）で引く
+    sql = (
+        "SELECT id, user_id, kind, retry_key, retry_key_created_at FROM reminders"
+        " WHERE sent_at IS NULL AND due_at <= ?"
+    )
+    params = [due_until.strftime(REMINDER_TIME_FORMAT)]
+    if max_age_days > 0:
+        sql += " AND due_at >= ?"
+        params.append(
+            (due_until - datetime.timedelta(days=max_age_days)).strftime(
+                REMINDER_TIME_FORMAT
             )
-            print("利用日の前日リマインダーの送信")
-            update_user_state(user_id, 4.9)
-
-        # 利用終了日1ヶ月後リマインダーの送信
-        cursor.execute(
-            "SELECT user_id FROM user_state WHERE after_use_ends BETWEEN ? AND ?",
-            (
-                one_day_ago.strftime("%Y-%m-%d %H:%M:%S"),
-                now.strftime("%Y-%m-%d %H:%M:%S"),
-            ),
         )
-        users_after_use_ends = cursor.fetchall()
+    rows = conn.execute(sql, params).fetchall()
 
-        messages = [
-            """本日で利用期間が終了です。ご利用ありがとうございました。最後に、下記のURLにアクセスし、アンケートにお答えください。\nhttp:// …\n（回答の際に研究IDが必要です）
-    """,
-            "また、さらに詳しいご感想を聞かせていただきたく、インタビュー調査も予定しています。ご協力くださる方は、アンケートの最後の同意確認欄と、個人情報をご入力ください。",
-        ]
-        for user in users_after_use_ends:
-            user_id = user[0]
-            line_bot_api.push_message(
-                user_id, [TextSendMessage(text=message) for message in messages]
-            )
-            send_confirm_message(user_id)
-            print("利用終了日1ヶ月後リマインダーの送信")
-            update_user_state(user_id, 5)
-
-        # 送信済みのリマインダーを削除（再送防止）
-        cursor.execute(
-            "UPDATE user_state SET reminder_3days = NULL WHERE reminder_3days = ?",
-            (now,),
+    expires_before = (
+        now - datetime.timedelta(hours=REMINDER_RETRY_KEY_TTL_HOURS)
+    ).strftime(REMINDER_TIME_FORMAT)
+    expired = [
+        row
+        for row in rows
+        if row[3] is not None and (row[4] is None or row[4] < expires_before)
+    ]
+    if expired:
+        print(f"retry_key の期限切れで再送しないリマインダー: {len(expired)} 件")
+        rows = [row for row in rows if row not in expired]
+
+    # (kind, メッセージの内容) ごとに宛先をまとめる
+    groups = {}
+    messages_by_key = {}
+    for reminder_id, user_id, kind, retry_key, _ in sorted(rows):
+        messages = reminder_messages(kind, user_id)
+        payload = json.dumps(messages, ensure_ascii=False, sort_keys=True)
+        messages_by_key[(kind, payload)] = messages
+        groups.setdefault((kind, payload), []).append(
+            (reminder_id, user_id, retry_key)
         )
-        cursor.execute(
-            "UPDATE user_state SET reminder_7days = NULL WHERE reminder_7days = ?",
-            (now,),
+
+    batches = []
+    new_keys = []
+    for (kind, payload), members in groups.items():
+        messages = messages_by_key[(kind, payload)]
+        # 前回の実行でキーが割り当て済みのものは、同じまとまりのまま送り直す
+        retried = {}
+        pending = []
+        for reminder_id, user_id, retry_key in members:
+            if retry_key is None:
+                pending.append((reminder_id, user_id))
+            else:
+                retried.setdefault(retry_key, []).append((reminder_id, user_id))
+        for retry_key, recipients in retried.items():
+            batches.append((kind, messages, retry_key, recipients))
+        for i in range(0, len(pending), MULTICAST_MAX_RECIPIENTS):
+            recipients = pending[i : i + MULTICAST_MAX_RECIPIENTS]
+            retry_key = str(uuid.uuid4())
+            new_keys.extend((retry_key, reminder_id) for reminder_id, _ in recipients)
+            batches.append((kind, messages, retry_key, recipients))
+
+    created_at = now.strftime(REMINDER_TIME_FORMAT)
+    with conn:
+        conn.executemany(
+            "UPDATE reminders SET retry_key = ?, retry_key_created_at = ? WHERE id = ?",
+            [(retry_key, created_at, reminder_id) for retry_key, reminder_id in new_keys],
         )
-        cursor.execute(
-            "UPDATE user_state SET reminder_14days = NULL WHERE reminder_14days = ?",
-            (now,),
+
+    return sorted(batches, key=lambda batch: REMINDER_ORDER[batch[0]])
+
+
+def mark_reminders_sent(batches, sent_at):
+    """送信済みの記録と step の更新を 1 トランザクションで行う（再送防止）"""
+    sent_at = sent_at.strftime(REMINDER_TIME_FORMAT)
+    conn = get_connection()
+    # update_user_states も同じ接続を使うので、その終了時にまとめてコミットされる
+    with conn:
+        conn.executemany(
+            "UPDATE reminders SET sent_at = ? WHERE id = ?",
+            [
+                (sent_at, reminder_id)
+                for _, _, _, recipients in batches
+                for reminder_id, _ in recipients
+            ],
         )
-        cursor.execute(
-            "UPDATE user_state SET reminder_21days = NULL WHERE reminder_21days = ?",
-            (now,),
+        # batches は種類の順に並んでいるので、ユーザーごとに最後の種類の step が残る
+        update_user_states(
+            [
+                (user_id, REMINDERS[kind][0])
+                for kind, _, _, recipients in batches
+                for _, user_id in recipients
+            ]
         )
-        cursor.execute(
-            "UPDATE user_state SET before_the_last_day = NULL WHERE before_the_last_day = ?",
-            (now,),
+
+
+async def _send_batch(dispatcher, batch):
+    kind, messages, retry_key, recipients = batch
+    log = REMINDERS[kind][2]
+    user_ids = [user_id for _, user_id in recipients]
+    if len(user_ids) == 1:
+        ok = await dispatcher.push(user_ids[0], messages, retry_key=retry_key)
+    else:
+        ok = await dispatcher.multicast(user_ids, messages, retry_key=retry_key)
+    if ok:
+        print(f"{log}: {len(user_ids)} 人")
+    else:
+        # 送信できなかったものは未送信のまま残し、次回の実行で同じ retry_key で送り直す
+        print(f"{log}に失敗: {len(user_ids)} 人")
+    return ok
+
+
+async def check_reminders_async(dispatcher=None, catch_up=False):
+    """リマインダーを確認し、送信する。すべて送信できた（または送るものがなかった）なら True
+
+    同じ内容のリマインダーは multicast で最大 500 人ずつまとめて送る。
+    同じユーザーへの送信順を保つため、種類ごとに順番に送り、同じ種類の中では並行して送る。
+    catch_up なら、直近の送信ジョブ（毎日 12 時）で送るはずだったものだけを送り直す
+    （それより後に期限が来たものは、次の送信ジョブまで送らない）。
+    """
+    with stage("check_reminders"):
+        return await _check_reminders(dispatcher, catch_up)
+
+
+async def _check_reminders(dispatcher, catch_up):
+    now = datetime.datetime.now(pytz.timezone("Asia/Tokyo"))
+    due_until = last_reminder_run(now) if catch_up else now
+    loop = asyncio.get_running_loop()
+
+    # DB の処理はスレッドで行い、イベントループを止めない
+    with stage("prepare_reminders"):
+        batches = await loop.run_in_executor(
+            None, prepare_due_reminders, now, REMINDER_MAX_AGE_DAYS, due_until
         )
-        cursor.execute(
-            "UPDATE user_state SET after_use_ends = NULL WHERE after_use_ends = ?",
-            (now,),
+
+    if dispatcher is None:
+        dispatcher = PushDispatcher()
+    sent = []
+    for _, kind_batches in groupby(batches, key=lambda batch: batch[0]):
+        kind_batches = list(kind_batches)
+        results = await asyncio.gather(
+            *[_send_batch(dispatcher, batch) for batch in kind_batches]
         )
+        sent.extend(batch for batch, ok in zip(kind_batches, results) if ok)
+
+    with stage("mark_reminders_sent"):
+        await loop.run_in_executor(None, mark_reminders_sent, sent, now)
+
+    total = sum(len(batch[3]) for batch in batches)
+    sent_count = sum(len(batch[3]) for batch in sent)
+    print(f"リマインダー送信: {sent_count}/{total} 件（{len(batches)} リクエスト）")
+    return sent_count == total
 
-        conn.commit()
 
+def check_reminders():
+    """リマインダーを確認し、送信する（スクリプトなどから同期的に呼ぶ場合）"""
+
+    async def run():
+        try:
+            await check_reminders_async()
+        finally:
+            await close_http_client()
 
-# # 1分ごとにチェック
-# scheduler.add_job(check_reminders, "interval", minutes=1)
-# scheduler.start()
+    asyncio.run(run())
@@ -0,0 +1,97 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserState:
+    """user_state の 1 行のうち、会話の処理で読む列"""
+
+    __slots__ = ("step", "research_id", "last_question", "expires_at")
+
+    def __init__(self, step, research_id, last_question, expires_at):
+        self.step = step
+        self.research_id = research_id
+        self.last_question = last_question
+        self.expires_at = expires_at
+
+
+class UserStateCache:
+    """user_state の読み込みを省くための、ユーザーごとの状態の LRU キャッシュ
+
+    - 最大 max_size 人まで保持し、ttl 秒経ったものは DB から読み直す
+    - DB への書き込みは write_lock を取って行い、コミット後に apply() で同じ変更を反映する
+      （書き込みの順序とキャッシュへの反映の順序が一致する）
+    - DB から読んだ値は、読み込みの間に書き込みがなかった場合だけ put() で保持する
+
+    max_size が 0 以下なら何も保持しない（常に DB から読む）。
+    """
+
+    def __init__(self, max_size=10000, ttl=600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self.write_lock = threading.RLock()
+        # apply() のたびに増やす（読み込み中に書き込みがあったかの判定に使う）
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, user_id):
+        """(step, research_id, last_question) を返す。保持していなければ None"""
+        with self._lock:
+            state = self._states.get(user_id)
+            if state is None or state.expires_at < time.monotonic():
+                self.misses += 1
+                return None
+            self._states.move_to_end(user_id)
+            self.hits += 1
+            return state.step, state.research_id, state.last_question
+
+    def put(self, user_id, row, version):
+        """DB から読んだ行を保持する（version は読み込み前の self.version）"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if version != self.version:
+                return
+            self._set(user_id, *row)
+
+    def apply(self, updates):
+        """update_user_states と同じ規則で、保持している状態を更新する"""
+        with self._lock:
+            self.version += 1
+            if not self.enabled:
+                return
+            for user_id, step, research_id, last_question, *_ in updates:
+                state = self._states.get(user_id)
+                if state is not None:
+                    # research_id は step 1 のとき、または未設定のときだけ書き換わる
+                    if step != 1 and state.research_id is not None:
+                        research_id = state.research_id
+                elif step != 1:
+                    # 以前の research_id がわからないので、次に読むときに DB から読む
+                    continue
+                self._set(user_id, step, research_id, last_question)
+
+    def _set(self, user_id, step, research_id, last_question):
+        self._states[user_id] = UserState(
+            step, research_id, last_question, time.monotonic() + self.ttl
+        )
+        self._states.move_to_end(user_id)
+        while len(self._states) > self.max_size:
+            self._states.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._states),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
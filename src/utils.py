@@ -3,34 +3,65 @@ import os
 import random
 import sqlite3
 import string
-import requests
+import threading
 import httpx
 import datetime
 import pytz
 from fastapi import FastAPI, Request
-from linebot.models import TextMessage
-from linebot.v3.messaging import (
-    AsyncApiClient,
-    AsyncMessagingApi,
-    Configuration,
-    ReplyMessageRequest,
-)
 from dotenv import load_dotenv
 
+from src.metrics import stage
+from src.process_lock import file_lock
+from src.state_cache import UserStateCache
+
 
 load_dotenv()
 
 channel_secret = os.getenv("LINE_CHANNEL_SECRET", None)
 channel_access_token = os.getenv("LINE_CHANNEL_ACCESS_TOKEN", None)
+# LINE Messaging API の URL（負荷試験ではローカルのモックサーバーに向ける）
+LINE_API_BASE_URL = os.getenv("LINE_API_BASE_URL", "https://api.line.me")
+# LINE API への接続数の上限
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
 
+app = FastAPI()
 
-configuration = Configuration(access_token=channel_access_token)
+# LINE API の呼び出しで共有する HTTP クライアント（アプリの起動時に作成し、終了時に閉じる）
+http_client = None
 
-app = FastAPI()
-async_api_client = AsyncApiClient(configuration)
-line_bot_api = AsyncMessagingApi(async_api_client)
+DB_PATH = os.getenv("DB_PATH", "./data/outputs/chatbot.db")
+# uvicorn のワーカー数（uvicorn の --workers の既定値と同じ環境変数）
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+# ユーザーの状態のキャッシュ（保持する人数・秒数）。0 人にすると毎回 DB から読む
+# キャッシュはプロセスごとなので、複数ワーカーでは既定で無効にする（ほかのワーカーの更新が見えない）
+USER_STATE_CACHE_SIZE = int(
+    os.getenv("USER_STATE_CACHE_SIZE", "10000" if WEB_CONCURRENCY <= 1 else "0")
+)
+USER_STATE_CACHE_TTL = float(os.getenv("USER_STATE_CACHE_TTL", "600"))
+user_state_cache = UserStateCache(USER_STATE_CACHE_SIZE, USER_STATE_CACHE_TTL)
+# WAL モードでは NORMAL でもコミット済みのデータは壊れない（電源断時に直近のコミットが失われうるのみ）
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+
+# 登録日時からのリマインダーの日数
+REMINDER_OFFSETS = (
+    ("reminder_3days", 3),
+    ("reminder_7days", 7),
+    ("reminder_14days", 14),
+    ("reminder_21days", 21),
+    ("before_the_last_day", 31),
+    ("after_use_ends", 31 + 31),
+)
+
+# reminders.due_at の形式（日本時間）。文字列の大小比較で日時を比較する
+REMINDER_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# リマインダーの送信ジョブを実行する時刻（日本時間）
+REMINDER_HOUR = 12
 
-DB_PATH = "./data/outputs/chatbot.db"
+_db_local = threading.local()
+_db_connections = []
+_db_connections_lock = threading.Lock()
+_db_generation = 0
 
 
 def get_jst_now(event):
@@ -48,9 +79,48 @@ def get_jst_now(event):
     return jst_dt
 
 
+def get_connection():
+    """スレッドごとに 1 本の SQLite 接続を作成し、使い回す
+
+    接続ごとに WAL モードと synchronous を設定する。同じ SQL 文は
+    sqlite3 のステートメントキャッシュによりコンパイル済みのものが再利用される。
+    """
+    conn = getattr(_db_local, "conn", None)
+    if conn is None or _db_local.generation != _db_generation:
+        conn = sqlite3.connect(
+            DB_PATH, timeout=30, cached_statements=256, check_same_thread=False
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        _db_local.conn = conn
+        _db_local.generation = _db_generation
+        with _db_connections_lock:
+            _db_connections.append(conn)
+    return conn
+
+
+def close_connections():
+    """すべてのスレッドの接続を閉じる（シャットダウン時に呼ぶ）"""
+    global _db_generation
+    with _db_connections_lock:
+        _db_generation += 1
+        for conn in _db_connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _db_connections.clear()
+
+
 # SQLite データベース（初回起動時にテーブルを作成）
 def initialize_db():
-    conn = sqlite3.connect(DB_PATH)
+    # 複数のワーカーが同時に起動しても、テーブルの作成と移行は 1 プロセスずつ行う
+    with file_lock(DB_PATH + ".init.lock"):
+        _initialize_db()
+
+
+def _initialize_db():
+    conn = get_connection()
     cursor = conn.cursor()
 
     # テーブル作成
@@ -87,45 +157,186 @@ def initialize_db():
         """
     )
 
+    # 送信予定のリマインダー（ユーザー × 種類ごとに 1 行）
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            due_at TEXT NOT NULL,
+            sent_at TEXT,
+            UNIQUE (user_id, kind)
+        )
+        """
+    )
+    # 未送信のリマインダーだけを送信日時で引く部分インデックス
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_reminders_pending_due_at
+        ON reminders (due_at) WHERE sent_at IS NULL
+        """
+    )
+
     conn.commit()
-    conn.close()
+
+    (user_version,) = cursor.execute("PRAGMA user_version").fetchone()
+    if user_version < 1:
+        migrate_reminders(conn)
+        conn.execute("PRAGMA user_version = 1")
+    if user_version < 2:
+        # 送信時の X-Line-Retry-Key（再実行時に同じキーで送り、二重送信を防ぐ）
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(reminders)")]
+        if "retry_key" not in columns:
+            conn.execute("ALTER TABLE reminders ADD COLUMN retry_key TEXT")
+        conn.execute("PRAGMA user_version = 2")
+    if user_version < 3:
+        # retry_key を割り当てた日時（LINE がキーを覚えている約 24 時間を過ぎたものは再送しない）
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(reminders)")]
+        if "retry_key_created_at" not in columns:
+            conn.execute("ALTER TABLE reminders ADD COLUMN retry_key_created_at TEXT")
+        conn.execute("PRAGMA user_version = 3")
+
+
+def last_reminder_run(now):
+    """now 以前で直近のリマインダーの送信ジョブ（毎日 REMINDER_HOUR 時）の時刻"""
+    last_run = now.replace(hour=REMINDER_HOUR, minute=0, second=0, microsecond=0)
+    if last_run > now:
+        last_run -= datetime.timedelta(days=1)
+    return last_run
+
+
+def migrate_reminders(conn):
+    """user_state のリマインダー列から reminders テーブルを作成する（初回のみ）
+
+    直近の送信ジョブ（毎日 12 時）までに期限が来ていたものは送信済みとして登録する。
+    """
+    jst = datetime.timezone(datetime.timedelta(hours=9))
+    now = datetime.datetime.now(jst)
+    last_run = last_reminder_run(now).strftime(REMINDER_TIME_FORMAT)
+    migrated_at = now.strftime(REMINDER_TIME_FORMAT)
+
+    with conn:
+        for kind, _ in REMINDER_OFFSETS:
+            # 保存されている値は "YYYY-MM-DD HH:MM:SS.ffffff+09:00" 形式なので先頭 19 文字を使う
+            conn.execute(
+                f"""
+                INSERT OR IGNORE INTO reminders (user_id, kind, due_at, sent_at)
+                SELECT user_id, ?, substr({kind}, 1, 19),
+                       CASE WHEN substr({kind}, 1, 19) <= ? THEN ? END
+                FROM user_state WHERE {kind} IS NOT NULL
+                """,
+                (kind, last_run, migrated_at),
+            )
 
 
 initialize_db()
 
 
+INSERT_CHAT_LOG_SQL = """
+    INSERT INTO chat_logs (user_id, message_id, user_message, response_id, reply_id, timestamp, version) 
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+
 # メッセージをデータベースに保存
 def save_message_to_db(
     user_id, message_id, user_message, response_id, reply_id, timestamp, version
 ):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    cursor.execute(
-        """
-        INSERT INTO chat_logs (user_id, message_id, user_message, response_id, reply_id, timestamp, version) 
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
-        (user_id, message_id, user_message, response_id, reply_id, timestamp, version),
+    save_messages_to_db(
+        [(user_id, message_id, user_message, response_id, reply_id, timestamp, version)]
     )
 
-    conn.commit()
-    conn.close()
+
+# 複数のメッセージを 1 トランザクションで保存
+def save_messages_to_db(rows):
+    conn = get_connection()
+
+    # 例外時はロールバックする（接続を使い回すので、トランザクションを残さない）
+    with stage("chat_log_write"), conn:
+        conn.executemany(INSERT_CHAT_LOG_SQL, rows)
 
 
 # ユーザーの状態を取得
 def get_user_state(user_id):
-    conn = sqlite3.connect(DB_PATH)  # 各関数ごとに接続を作成
-    cursor = conn.cursor()
+    # よく使うユーザーの状態はメモリから返す（DB を読まない）
+    row = user_state_cache.get(user_id)
+    if row is not None:
+        return row
+    version = user_state_cache.version
 
-    cursor.execute(
-        "SELECT step, research_id, last_question FROM user_state WHERE user_id=?",
-        (user_id,),
-    )
-    row = cursor.fetchone()
+    conn = get_connection()  # スレッドごとの接続を使い回す
+    cursor = conn.cursor()
 
-    conn.close()
-    return row if row else (0, None, None)
+    with stage("get_user_state_db"):
+        cursor.execute(
+            "SELECT step, research_id, last_question FROM user_state WHERE user_id=?",
+            (user_id,),
+        )
+        row = cursor.fetchone()
+
+    if row:
+        user_state_cache.put(user_id, row, version)
+        return row
+    return (0, None, None)
+
+
+# user_state を 1 文で挿入・更新する
+# - research_id: step 1 のとき、または未設定のときだけ新しい値を使う（すでにある場合は変更しない）
+# - registration_time とリマインダー: registration_time が渡されたときだけ書き換え、それ以外は保持する
+UPSERT_USER_STATE_SQL = """
+    INSERT INTO user_state (user_id, step, research_id, last_question, registration_time, reminder_3days, reminder_7days, reminder_14days, reminder_21days, before_the_last_day, after_use_ends)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        step = excluded.step,
+        last_question = excluded.last_question,
+        research_id = CASE
+            WHEN excluded.step = 1 OR user_state.research_id IS NULL THEN excluded.research_id
+            ELSE user_state.research_id
+        END,
+        registration_time = CASE
+            WHEN excluded.registration_time IS NOT NULL THEN excluded.registration_time
+            ELSE user_state.registration_time
+        END,
+        reminder_3days = CASE
+            WHEN excluded.registration_time IS NOT NULL THEN excluded.reminder_3days
+            ELSE user_state.reminder_3days
+        END,
+        reminder_7days = CASE
+            WHEN excluded.registration_time IS NOT NULL THEN excluded.reminder_7days
+            ELSE user_state.reminder_7days
+        END,
+        reminder_14days = CASE
+            WHEN excluded.registration_time IS NOT NULL THEN excluded.reminder_14days
+            ELSE user_state.reminder_14days
+        END,
+        reminder_21days = CASE
+            WHEN excluded.registration_time IS NOT NULL THEN excluded.reminder_21days
+            ELSE user_state.reminder_21days
+        END,
+        before_the_last_day = CASE
+            WHEN excluded.registration_time IS NOT NULL THEN excluded.before_the_last_day
+            ELSE user_state.before_the_last_day
+        END,
+        after_use_ends = CASE
+            WHEN excluded.registration_time IS NOT NULL THEN excluded.after_use_ends
+            ELSE user_state.after_use_ends
+        END
+"""
+
+
+def _user_state_params(
+    user_id, step, research_id=None, last_question=None, registration_time=None
+):
+    # registration_time が渡された場合はリマインダーの日時を計算する
+    if registration_time is not None:
+        reminders = [
+            registration_time + datetime.timedelta(days=days)
+            for _, days in REMINDER_OFFSETS
+        ]
+    else:
+        reminders = [None] * len(REMINDER_OFFSETS)
+    return (user_id, step, research_id, last_question, registration_time, *reminders)
 
 
 # ユーザーの状態を更新
@@ -136,121 +347,123 @@ def update_user_state(
     last_question=None,
     registration_time=None,
 ):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    # 既存の research_id, registration_time, reminder_3days, reminder_7days を取得
-    cursor.execute(
-        "SELECT research_id, registration_time, reminder_3days, reminder_7days, reminder_14days, reminder_21days, before_the_last_day, after_use_ends FROM user_state WHERE user_id=?",
-        (user_id,),
+    update_user_states(
+        [(user_id, step, research_id, last_question, registration_time)]
     )
-    row = cursor.fetchone()
 
-    existing_research_id = None
-    existing_registration_time = None
-    existing_reminder_3days = None
-    existing_reminder_7days = None
-    existing_reminder_14days = None
-    existing_reminder_21days = None
-    existing_before_the_last_day = None
-    existing_after_use_ends = None
 
-    if row is not None:
-        (
-            existing_research_id,
-            existing_registration_time,
-            existing_reminder_3days,
-            existing_reminder_7days,
-            existing_reminder_14days,
-            existing_reminder_21days,
-            existing_before_the_last_day,
-            existing_after_use_ends,
-        ) = row
-
-        # research_id の更新ロジック（すでにある場合は変更しない）
-        if step == 1:
-            pass  # 新しい research_id を適用
-        elif existing_research_id is None and research_id is not None:
-            pass  # 新しい research_id を適用
-        else:
-            research_id = existing_research_id  # 既存の値を保持
-
-    # registration_time の更新ロジック（すでにある場合は変更しない）
-    if registration_time is not None:
-        registration_time = registration_time
-        # 3日後と1週間後のリマインダーを計算
-        reminder_3days = registration_time + datetime.timedelta(days=3)
-        reminder_7days = registration_time + datetime.timedelta(days=7)
-        reminder_14days = registration_time + datetime.timedelta(days=14)
-        reminder_21days = registration_time + datetime.timedelta(days=21)
-        before_the_last_day = registration_time + datetime.timedelta(days=31)
-        after_use_ends = registration_time + datetime.timedelta(days=31+31)
-
-    elif existing_registration_time is not None:
-        registration_time = existing_registration_time
-        reminder_3days = existing_reminder_3days
-        reminder_7days = existing_reminder_7days
-        reminder_14days = existing_reminder_14days
-        reminder_21days = existing_reminder_21days
-        before_the_last_day = existing_before_the_last_day
-        after_use_ends = existing_after_use_ends
-
-    # データが存在するか確認
-    cursor.execute(
-        "SELECT 1 FROM user_state WHERE user_id=?",
-        (user_id,),
-    )
-    exists = cursor.fetchone()
+# registration_time が渡された場合はリマインダーを登録し直す（未送信に戻す）
+# 以前の送信で使った retry_key も消す（同じキーで送ると LINE に重複とみなされ、届かない）
+UPSERT_REMINDER_SQL = """
+    INSERT INTO reminders (user_id, kind, due_at) VALUES (?, ?, ?)
+    ON CONFLICT(user_id, kind) DO UPDATE SET
+        due_at = excluded.due_at, sent_at = NULL, retry_key = NULL, retry_key_created_at = NULL
+"""
 
-    if exists:
-        # 既存のデータを更新（reminder_3days, reminder_7days は保持）
-        cursor.execute(
-            """UPDATE user_state 
-               SET step=?, last_question=?, research_id=?, registration_time=?, reminder_3days=?, reminder_7days=?, reminder_14days=?, reminder_21days=?, before_the_last_day=?, after_use_ends=?
-               WHERE user_id=?""",
-            (
-                step,
-                last_question,
-                research_id,
-                registration_time,
-                reminder_3days,
-                reminder_7days,
-                reminder_14days,
-                reminder_21days,
-                before_the_last_day,
-                after_use_ends,
-                user_id,
+
+def _reminder_params(user_id, registration_time):
+    return [
+        (
+            user_id,
+            kind,
+            (registration_time + datetime.timedelta(days=days)).strftime(
+                REMINDER_TIME_FORMAT
             ),
         )
-    else:
-        # 初回登録時のみリマインダーを設定
-        cursor.execute(
-            """INSERT INTO user_state (user_id, step, research_id, last_question, registration_time, reminder_3days, reminder_7days, reminder_14days, reminder_21days, before_the_last_day, after_use_ends)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (
-                user_id,
-                step,
-                research_id,
-                last_question,
-                registration_time,
-                reminder_3days,
-                reminder_7days,
-                reminder_14days,
-                reminder_21days,
-                before_the_last_day,
-                after_use_ends,
+        for kind, days in REMINDER_OFFSETS
+    ]
+
+
+# 複数ユーザーの状態を 1 トランザクションで更新（リマインダーの送信処理で使う）
+def update_user_states(updates):
+    """updates は update_user_state の引数のタプル (user_id, step[, research_id, last_question, registration_time]) のリスト"""
+    params = [_user_state_params(*update) for update in updates]
+    reminders = [
+        reminder
+        for user_id, _, _, _, registration_time, *_ in params
+        if registration_time is not None
+        for reminder in _reminder_params(user_id, registration_time)
+    ]
+
+    conn = get_connection()
+    # DB への書き込みとキャッシュへの反映を、ほかの書き込みと同じ順序で行う
+    with stage("update_user_state"), user_state_cache.write_lock:
+        with conn:
+            conn.executemany(UPSERT_USER_STATE_SQL, params)
+            if reminders:
+                conn.executemany(UPSERT_REMINDER_SQL, reminders)
+        user_state_cache.apply(params)
+
+
+def open_http_client():
+    """keep-alive で接続を使い回す HTTP クライアントを作成する
+
+    h2 がインストールされていれば HTTP/2 を使う。
+    """
+    global http_client
+    if http_client is None:
+        try:
+            import h2  # noqa: F401
+
+            http2 = True
+        except ImportError:
+            http2 = False
+        http_client = httpx.AsyncClient(
+            base_url=LINE_API_BASE_URL,
+            headers={"Authorization": f"Bearer {channel_access_token}"},
+            http2=http2,
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=60.0,
             ),
         )
+    return http_client
 
-    conn.commit()
-    conn.close()
+
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        client, http_client = http_client, None
+        await client.aclose()
+
+
+def get_http_client():
+    # アプリの外（スクリプトなど）から呼ばれた場合もここで作成する
+    return http_client if http_client is not None else open_http_client()
+
+
+async def post_line_api(path, data, stage_name="line_api"):
+    """LINE Messaging API に POST する（エラー時は httpx.HTTPStatusError）"""
+    with stage(stage_name):
+        response = await get_http_client().post(path, json=data)
+        response.raise_for_status()
+    return response
+
+
+async def reply_message(request):
+    """ReplyMessageRequest を送る（共有の HTTP クライアントを使う）"""
+    return await post_line_api(
+        "/v2/bot/message/reply", request.to_dict(), "reply_message"
+    )
+
+
+async def push_message(request):
+    """PushMessageRequest を送る（共有の HTTP クライアントを使う）"""
+    return await post_line_api(
+        "/v2/bot/message/push", request.to_dict(), "push_message"
+    )
 
 
 async def reply(event, message):
-    await line_bot_api.reply_message(
-        ReplyMessageRequest(
-            reply_token=event.reply_token, messages=[TextMessage(text=message)]
-        )
+    await post_line_api(
+        "/v2/bot/message/reply",
+        {
+            "replyToken": event.reply_token,
+            "messages": [{"type": "text", "text": message}],
+        },
+        "reply_message",
     )
 
 
@@ -259,32 +472,30 @@ def generate_random_string(length):
     return "".join(random.choice(letters) for _ in range(length))
 
 
+# アンケート回答の確認メッセージ
+CONFIRM_MESSAGE = {
+    "type": "template",
+    "altText": "確認メッセージ",
+    "template": {
+        "type": "confirm",
+        "text": "アンケートの回答は終了しましたか？",
+        "actions": [
+            {"type": "message", "label": "はい", "text": "はい"},
+            {"type": "message", "label": "いいえ", "text": "いいえ"},
+        ],
+    },
+}
+
+
 # メッセージ送信関数
-def send_confirm_message(user_id):
-    url = "https://api.line.me/v2/bot/message/push"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {channel_access_token}",
-    }
+async def send_confirm_message(user_id):
     data = {
         "to": user_id,  # 送信先のユーザーID
-        "messages": [
-            {
-                "type": "template",
-                "altText": "確認メッセージ",
-                "template": {
-                    "type": "confirm",
-                    "text": "アンケートの回答は終了しましたか？",
-                    "actions": [
-                        {"type": "message", "label": "はい", "text": "はい"},
-                        {"type": "message", "label": "いいえ", "text": "いいえ"},
-                    ],
-                },
-            }
-        ],
+        "messages": [CONFIRM_MESSAGE],
     }
 
-    requests.post(url, headers=headers, data=json.dumps(data))
+    with stage("push_message"):
+        await get_http_client().post("/v2/bot/message/push", json=data)
 
 
 @app.post("/callback")
@@ -312,28 +523,20 @@ async def confirm_callback(request: Request):
 
 # LINE に返信を送る関数
 async def reply_text(user_id: str, message: str):
-    url = "https://api.line.me/v2/bot/message/push"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {channel_access_token}",
-    }
     data = {"to": user_id, "messages": [{"type": "text", "text": message}]}
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=data)
+    with stage("push_message"):
+        response = await get_http_client().post("/v2/bot/message/push", json=data)
 
 
 # ローディングアニメーションを表示する関数
 async def start_loading_animation(user_id: str, loading_seconds: int = 5):
-    url = "https://api.line.me/v2/bot/chat/loading/start"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {channel_access_token}",
-    }
     data = {
         "chatId": user_id,  # ユーザーの ID（event["source"]["userId"] で取得）
         "loadingSeconds": loading_seconds,  # ローディングの秒数 (最大 10秒)
     }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers, json=data)
+    with stage("loading_animation"):
+        response = await get_http_client().post(
+            "/v2/bot/chat/loading/start", json=data
+        )
@@ -0,0 +1,200 @@
+import numpy as np
+
+
+def top_k(scores, k):
+    """類似度の行列 (クエリ数, 件数) から上位 k 件の列番号とスコアを返す（スコアの降順）"""
+    k = min(k, scores.shape[1])
+    if k == 1:
+        top_indices = np.argmax(scores, axis=1)[:, None]
+    elif k < scores.shape[1]:
+        top_indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top_indices = np.tile(np.arange(scores.shape[1]), (len(scores), 1))
+    top_scores = np.take_along_axis(scores, top_indices, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return (
+        np.take_along_axis(top_indices, order, axis=1),
+        np.take_along_axis(top_scores, order, axis=1),
+    )
+
+
+class BruteForceIndex:
+    """すべてのベクトルとの内積を計算する（正確な検索）
+
+    ベクトルは L2 正規化済みとし、内積をコサイン類似度として扱う。
+    ids を省略すると行番号を ID とする。
+    """
+
+    kind = "brute"
+
+    def __init__(self, vectors, ids=None):
+        # mmap の float32 配列はコピーせずにそのまま使う
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.ids = (
+            np.arange(len(self.vectors), dtype=np.int64)
+            if ids is None
+            else np.asarray(ids, dtype=np.int64)
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, queries, k=1):
+        """上位 k 件の (ID, スコア) を、どちらも (クエリ数, k) の配列で返す
+
+        件数が k 件に満たない場合は、列数が件数までになる（IvfIndex と同じ）。
+        """
+        top_indices, top_scores = top_k(queries @ self.vectors.T, k)
+        return self.ids[top_indices], top_scores
+
+    def add(self, ids, vectors):
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+        self.vectors = np.concatenate(
+            [self.vectors, np.asarray(vectors, dtype=np.float32)]
+        )
+
+    def remove(self, ids):
+        keep = ~np.isin(self.ids, np.asarray(ids, dtype=np.int64))
+        self.ids = self.ids[keep]
+        self.vectors = np.ascontiguousarray(self.vectors[keep])
+
+
+class IvfIndex:
+    """転置ファイル（IVF）による近似最近傍検索
+
+    ベクトルを k-means で nlist 個のクラスタに分け、クエリに近い nprobe 個の
+    クラスタの中だけを探す。nprobe を増やすほど正確になり、遅くなる。
+    クラスタには行番号だけを持ち、ベクトルは作成時の配列（mmap ならワーカー間で共有されるページ）
+    から検索のたびに取り出す。
+    add() / remove() は該当するクラスタだけを更新するので、全体を作り直さない
+    （クラスタの中心は作成時のまま。add() したベクトルはプロセスごとの配列に持ち、
+    remove() しても領域は解放しない。大きく入れ替えた場合は作り直す）。
+    """
+
+    kind = "ivf"
+
+    def __init__(self, vectors, ids=None, nlist=0, nprobe=8, n_iter=10, seed=0):
+        # mmap の float32 配列はコピーせずにそのまま使う
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if ids is None:
+            ids = np.arange(len(self.vectors), dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+        if nlist <= 0:
+            # 1 クラスタあたり数百件程度になるように決める
+            nlist = int(np.sqrt(len(self.vectors)) * 2)
+        self.nlist = max(1, min(nlist, len(self.vectors)))
+        self.nprobe = nprobe
+        self.centroids = self._train(self.vectors, self.nlist, n_iter, seed)
+
+        # add() で追加したベクトル（行番号は len(self.vectors) から続く）
+        self.added_vectors = np.empty((0, self.vectors.shape[1]), dtype=np.float32)
+        self.list_ids = [np.empty(0, dtype=np.int64) for _ in range(self.nlist)]
+        self.list_rows = [np.empty(0, dtype=np.int64) for _ in range(self.nlist)]
+        # ID → クラスタ番号（remove で使う）
+        self.assignment = {}
+        self._insert(ids, np.arange(len(self.vectors), dtype=np.int64), self.vectors)
+
+    @staticmethod
+    def _train(vectors, nlist, n_iter, seed):
+        """球面 k-means（内積で割り当て、中心は正規化）でクラスタの中心を求める"""
+        rng = np.random.default_rng(seed)
+        # 学習には 1 クラスタあたり最大 256 件をサンプリングして使う
+        sample_size = min(len(vectors), nlist * 256)
+        sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(n_iter):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            empty = norms[:, 0] == 0
+            # 空のクラスタは中心を動かさない
+            sums[empty] = centroids[empty]
+            norms[empty] = 1.0
+            centroids = sums / norms
+        return np.ascontiguousarray(centroids, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.assignment)
+
+    def add(self, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(ids) == 0:
+            return
+        # 既存の ID は置き換える
+        self.remove([i for i in ids.tolist() if i in self.assignment])
+        rows = np.arange(len(vectors), dtype=np.int64) + (
+            len(self.vectors) + len(self.added_vectors)
+        )
+        self.added_vectors = np.concatenate([self.added_vectors, vectors])
+        self._insert(ids, rows, vectors)
+
+    def _insert(self, ids, rows, vectors):
+        assign = np.argmax(vectors @ self.centroids.T, axis=1)
+        for list_no in np.unique(assign).tolist():
+            mask = assign == list_no
+            self.list_ids[list_no] = np.concatenate([self.list_ids[list_no], ids[mask]])
+            self.list_rows[list_no] = np.concatenate([self.list_rows[list_no], rows[mask]])
+        self.assignment.update(zip(ids.tolist(), assign.tolist()))
+
+    def remove(self, ids):
+        by_list = {}
+        for i in ids:
+            list_no = self.assignment.pop(int(i), None)
+            if list_no is not None:
+                by_list.setdefault(list_no, []).append(int(i))
+        for list_no, removed in by_list.items():
+            keep = ~np.isin(self.list_ids[list_no], removed)
+            self.list_ids[list_no] = self.list_ids[list_no][keep]
+            self.list_rows[list_no] = self.list_rows[list_no][keep]
+
+    def _gather(self, rows):
+        # 作成時の配列の行はそのまま取り出し、add() した行だけ別の配列から取り出す
+        if len(self.added_vectors) == 0 or rows.max() < len(self.vectors):
+            return self.vectors[rows]
+        added = rows >= len(self.vectors)
+        candidates = np.empty((len(rows), self.vectors.shape[1]), dtype=np.float32)
+        candidates[~added] = self.vectors[rows[~added]]
+        candidates[added] = self.added_vectors[rows[added] - len(self.vectors)]
+        return candidates
+
+    def search(self, queries, k=1):
+        """上位 k 件の (ID, スコア) を、どちらも (クエリ数, k) の配列で返す
+
+        k 件の候補が集まるまでクラスタを探すので、件数が k 件に満たない場合だけ
+        列数が件数までになる（BruteForceIndex と同じ）。
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        k = min(k, len(self))
+        probe_order = np.argsort(-(queries @ self.centroids.T), axis=1)
+        result_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        result_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for q, order in enumerate(probe_order):
+            # nprobe 個のクラスタを探し、k 件に満たなければ次に近いクラスタも探す
+            lists = []
+            count = 0
+            for list_no in order.tolist():
+                if len(lists) >= self.nprobe and count >= k:
+                    break
+                if len(self.list_ids[list_no]):
+                    lists.append(list_no)
+                    count += len(self.list_ids[list_no])
+            if not lists:
+                continue
+            candidate_ids = np.concatenate([self.list_ids[i] for i in lists])
+            candidates = self._gather(np.concatenate([self.list_rows[i] for i in lists]))
+            top_indices, top_scores = top_k(queries[q : q + 1] @ candidates.T, k)
+            n = top_indices.shape[1]
+            result_ids[q, :n] = candidate_ids[top_indices[0]]
+            result_scores[q, :n] = top_scores[0]
+        return result_ids, result_scores
+
+
+def create_vector_index(kind, vectors, **kwargs):
+    """設定値からベクトルインデックスを作成する（"brute" または "ivf"）"""
+    if kind == "brute":
+        return BruteForceIndex(vectors, **kwargs)
+    if kind == "ivf":
+        return IvfIndex(vectors, **kwargs)
+    raise ValueError(f"Unknown vector index: {kind}")
@@ -0,0 +1,25 @@
+import os
+import tempfile
+
+import pytest
+
+# src.utils は import 時に DB_PATH のデータベースを作るので、本番の DB を触らないよう先に差し替える
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "chatbot.db")
+os.environ["SCHEDULER_LOCK_PATH"] = os.path.join(tempfile.mkdtemp(), "scheduler.lock")
+# src.rule は LINE のチャネルの設定がないと終了するので、テスト用の値を入れておく
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test-secret")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test-token")
+
+
+@pytest.fixture(autouse=True)
+def db(tmp_path, monkeypatch):
+    """テストごとに空の DB とユーザー状態のキャッシュを使う"""
+    from src import utils
+    from src.state_cache import UserStateCache
+
+    utils.close_connections()
+    monkeypatch.setattr(utils, "DB_PATH", str(tmp_path / "chatbot.db"))
+    monkeypatch.setattr(utils, "user_state_cache", UserStateCache(100, 600))
+    utils.initialize_db()
+    yield
+    utils.close_connections()
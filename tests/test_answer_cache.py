@@ -0,0 +1,22 @@
+from src.answer_cache import AnswerCache, normalize_text
+from src.metrics import faq_cache_lookups_total, render
+
+
+def lookups():
+    return dict(faq_cache_lookups_total._values)
+
+
+def test_lookups_are_exported_as_counters():
+    cache = AnswerCache(["乳がんとは？"], ["はい\tいいえ"], max_size=2)
+    before = lookups()
+
+    assert cache.get(normalize_text("乳がんとは？")) == (0, 1.0)
+    assert cache.get("抗がん剤の副作用") is None
+    cache.put("抗がん剤の副作用", (0, 0.8))
+    assert cache.get("抗がん剤の副作用") == (0, 0.8)
+
+    after = lookups()
+    for result, count in (("exact", 1), ("recent", 1), ("miss", 1), ("pinned", 0)):
+        assert after.get(result, 0) - before.get(result, 0) == count
+    assert cache.stats()["misses"] == 1
+    assert 'chatbot_faq_cache_lookups_total{result="exact"}' in render()
@@ -0,0 +1,93 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from src.batching import BatcherClosedError, MicroBatcher
+
+
+def test_close_resolves_every_waiting_caller():
+    release = threading.Event()
+
+    def batch_fn(items):
+        release.wait(5)
+        return [item * 2 for item in items]
+
+    async def main():
+        executor = ThreadPoolExecutor(max_workers=1)
+        batcher = MicroBatcher(
+            batch_fn, executor, max_batch_size=2, max_wait=0.01, max_in_flight=1
+        )
+        # 1 つ目のバッチが実行中の間に、枠の空きを待つバッチとキューに残る入力を作る
+        tasks = [asyncio.ensure_future(batcher.submit(i)) for i in range(6)]
+        await asyncio.sleep(0.1)
+
+        closing = asyncio.ensure_future(batcher.close())
+        await asyncio.sleep(0.05)
+        release.set()
+        await asyncio.wait_for(closing, 5)
+        results = await asyncio.wait_for(
+            asyncio.gather(*tasks, return_exceptions=True), 5
+        )
+        executor.shutdown()
+
+        with pytest.raises(BatcherClosedError):
+            await batcher.submit(10)
+        return results
+
+    results = asyncio.run(main())
+    # 実行中だったバッチは結果を返し、残りは例外で終わる（待ち続けるものはない）
+    assert results[:2] == [0, 2]
+    assert all(isinstance(result, BatcherClosedError) for result in results[2:])
+
+
+def test_afind_option_retries_on_the_reloaded_service(monkeypatch):
+    from src import find_answer
+
+    class Service:
+        def __init__(self, response):
+            self.response = response
+
+        async def aget_response(self, input_text):
+            if self.response is None:
+                # 処理を待つ間に読み直され、この FaqService が閉じられた
+                monkeypatch.setattr(find_answer, "faq_service", new_service)
+                raise BatcherClosedError("micro batcher is closed")
+            return self.response
+
+    new_service = Service((["回答"], "", "", 0))
+    monkeypatch.setattr(find_answer, "faq_service", Service(None))
+
+    assert asyncio.run(find_answer.afind_option("質問")) == (["回答"], "", "", 0)
+
+
+def test_batch_stages_are_recorded_in_every_callers_trace(monkeypatch):
+    from src import metrics
+
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", True)
+    monkeypatch.setattr(metrics, "TRACE_LOG", True)
+
+    def batch_fn(items):
+        with metrics.stage("encode"):
+            return list(items)
+
+    async def lookup(batcher, item):
+        token = metrics.start_trace(item=item)
+        trace = metrics.current_trace()
+        with metrics.stage("faq_lookup"):
+            await batcher.submit(item)
+        metrics.finish_trace(token)
+        return [name for name, _ in trace["stages"]]
+
+    async def main():
+        executor = ThreadPoolExecutor(max_workers=1)
+        batcher = MicroBatcher(batch_fn, executor, max_batch_size=8, max_wait=0.05)
+        stages = await asyncio.gather(*[lookup(batcher, i) for i in range(3)])
+        await batcher.close()
+        executor.shutdown()
+        return stages
+
+    stages = asyncio.run(main())
+    # 3 件は 1 つのバッチで encode され、その時間がそれぞれのトレースに残る
+    assert stages == [["encode", "faq_lookup"]] * 3
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from src.embedding_index import load_or_build_index
+
+
+def encode(texts):
+    vectors = np.array([[len(text), 1.0, 0.0] for text in texts], dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def write_csv(path, text):
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def test_empty_faq_raises_a_clear_error(tmp_path):
+    csv_path = write_csv(tmp_path / "faq.csv", "Question\n")
+
+    with pytest.raises(ValueError, match="no rows"):
+        load_or_build_index(str(tmp_path / "index"), csv_path, [], "stub", encode, "float32")
+
+
+def test_float32_index_is_memory_mapped(tmp_path):
+    csv_path = write_csv(tmp_path / "faq.csv", "Question\na\nbb\n")
+    index_dir = str(tmp_path / "index")
+
+    load_or_build_index(index_dir, csv_path, ["a", "bb"], "stub", encode, "float32")
+    embeddings = load_or_build_index(index_dir, csv_path, ["a", "bb"], "stub", encode, "float32")
+
+    # 2 回目はファイルを mmap するだけ（ワーカー間でページを共有できる）
+    assert isinstance(embeddings, np.memmap)
+    np.testing.assert_allclose(embeddings, encode(["a", "bb"]))
@@ -0,0 +1,74 @@
+import csv
+
+import numpy as np
+import pytest
+
+from src.answer_cache import normalize_text
+from src.find_answer import FaqService
+from src.prefilter import FALLBACK_MESSAGES, prefilter
+
+
+@pytest.mark.parametrize(
+    "text, reason",
+    [
+        ("こんにちは", "greeting"),
+        ("こんにちは！", "greeting"),
+        ("ありがとうございました。", "greeting"),
+        ("👍", "not_a_question"),
+        ("？？", "not_a_question"),
+        ("12345678", "not_a_question"),
+        ("あ", "not_a_question"),
+        ("乳がんの検査について教えてください", None),
+        ("HER2", None),
+        ("はい", None),
+        ("いいえ", None),
+        ("OK", None),
+    ],
+)
+def test_prefilter(text, reason):
+    assert prefilter(normalize_text(text)) == reason
+
+
+class StubEncoder:
+    """文字列ごとに決まったベクトルを返す（モデルを読み込まない）"""
+
+    identifier = "stub"
+
+    def load(self):
+        pass
+
+    def encode(self, texts):
+        vectors = np.array(
+            [np.random.default_rng(len(text)).standard_normal(8) for text in texts],
+            dtype=np.float32,
+        )
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def service(tmp_path):
+    path = tmp_path / "faq.csv"
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            ["Question", "Answer", "URL", "Qestion_interpreting", "Option", "Option_question"]
+        )
+        writer.writerow(["手術の後の生活は？", "", "", "どちらですか？", "了解\tいいえ", "了解\tいいえ"])
+        writer.writerow(["はい", "回答 1", "", "", "", ""])
+        writer.writerow(["乳がんの検査について", "回答 2", "", "", "", ""])
+    service = FaqService(str(path), index_dir=str(tmp_path / "index"), encoder=StubEncoder())
+    yield service
+    service.executor.shutdown()
+
+
+def test_canned_responses_skip_the_search(service):
+    assert service.get_response("こんにちは！") == ([FALLBACK_MESSAGES["greeting"]], "", "", -1)
+    assert service.get_response("👍") == ([FALLBACK_MESSAGES["not_a_question"]], "", "", -1)
+
+
+def test_questions_and_quick_reply_choices_are_searched(service):
+    assert service.get_response("乳がんの検査について")[3] == 2
+    # クイックリプライの選択肢は、挨拶のような短い文字列でも定型文にしない
+    assert prefilter(normalize_text("了解")) == "greeting"
+    assert service.prefilter_reason(normalize_text("了解")) is None
+    assert service.get_response("了解")[3] != -1
@@ -0,0 +1,181 @@
+import asyncio
+import datetime
+import types
+
+from src import send_reminders, utils
+
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+
+
+class FakeDispatcher:
+    """push / multicast の呼び出しを記録し、ok の値を返す"""
+
+    def __init__(self, ok):
+        self.ok = ok
+        self.calls = []
+
+    async def push(self, user_id, messages, retry_key=None):
+        self.calls.append(([user_id], retry_key))
+        return self.ok
+
+    async def multicast(self, user_ids, messages, retry_key=None):
+        self.calls.append((list(user_ids), retry_key))
+        return self.ok
+
+
+def pending_reminders():
+    return utils.get_connection().execute(
+        "SELECT user_id, kind, retry_key FROM reminders WHERE sent_at IS NULL ORDER BY id"
+    ).fetchall()
+
+
+def run_at(monkeypatch, now, dispatcher):
+    class FrozenDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now
+
+    # send_reminders から見える datetime だけを差し替える
+    monkeypatch.setattr(
+        send_reminders,
+        "datetime",
+        types.SimpleNamespace(datetime=FrozenDatetime, timedelta=datetime.timedelta),
+    )
+    asyncio.run(send_reminders.check_reminders_async(dispatcher))
+
+
+def test_failed_reminders_are_sent_on_a_later_run(monkeypatch):
+    registered = datetime.datetime(2025, 1, 1, 10, 0, tzinfo=JST)
+    utils.update_user_states(
+        [("U1", 2, "R001", None, registered), ("U2", 2, "R002", None, registered)]
+    )
+    first_run = datetime.datetime(2025, 1, 4, 12, 0, tzinfo=JST)
+
+    failing = FakeDispatcher(ok=False)
+    run_at(monkeypatch, first_run, failing)
+    assert len(failing.calls) == 1
+    ((user_ids, retry_key),) = failing.calls
+    assert sorted(user_ids) == ["U1", "U2"]
+    # 失敗した 3 日後のリマインダーは未送信のまま、キーが保存されている
+    failed = [row for row in pending_reminders() if row[1] == "reminder_3days"]
+    assert [row[2] for row in failed] == [retry_key, retry_key]
+
+    # 期限内の次の実行で、同じまとまりを同じキーで送り直す
+    succeeding = FakeDispatcher(ok=True)
+    run_at(monkeypatch, first_run + datetime.timedelta(hours=1), succeeding)
+    assert [(sorted(user_ids), key) for user_ids, key in succeeding.calls] == [
+        (["U1", "U2"], retry_key)
+    ]
+    assert all(kind != "reminder_3days" for _, kind, _ in pending_reminders())
+    assert utils.get_user_state("U1")[0] == 4.3
+
+
+def test_default_max_age_drops_reminders_older_than_a_day():
+    registered = datetime.datetime(2025, 1, 1, 10, 0, tzinfo=JST)
+    utils.update_user_state("U1", 2, "R001", None, registered)
+
+    # 1 月 15 日 12 時の時点で、1 日以内に期限が来たのは 14 日後のリマインダーだけ
+    now = datetime.datetime(2025, 1, 15, 12, 0, tzinfo=JST)
+    batches = send_reminders.prepare_due_reminders(now)
+    assert [batch[0] for batch in batches] == ["reminder_14days"]
+
+    # 実行が止まっていた場合も、古いリマインダーをまとめて送らない
+    now = datetime.datetime(2025, 1, 20, 12, 0, tzinfo=JST)
+    assert send_reminders.prepare_due_reminders(now) == []
+
+
+def test_max_age_skips_old_reminders():
+    registered = datetime.datetime(2025, 1, 1, 10, 0, tzinfo=JST)
+    utils.update_user_state("U1", 2, "R001", None, registered)
+    now = datetime.datetime(2025, 1, 20, 12, 0, tzinfo=JST)
+
+    kinds = lambda batches: [batch[0] for batch in batches]
+    assert kinds(send_reminders.prepare_due_reminders(now, max_age_days=0)) == [
+        "reminder_3days",
+        "reminder_7days",
+        "reminder_14days",
+    ]
+    assert kinds(send_reminders.prepare_due_reminders(now, max_age_days=7)) == [
+        "reminder_14days"
+    ]
+
+
+def test_reregistration_clears_retry_key(monkeypatch):
+    registered = datetime.datetime(2025, 1, 1, 10, 0, tzinfo=JST)
+    utils.update_user_state("U1", 2, "R001", None, registered)
+    run_at(monkeypatch, datetime.datetime(2025, 1, 4, 12, 0, tzinfo=JST), FakeDispatcher(ok=True))
+
+    # 再登録したリマインダーは新しいまとまりとして、新しいキーで送る
+    utils.update_user_state("U1", 1, None, None, datetime.datetime(2025, 2, 1, 10, 0, tzinfo=JST))
+    assert all(retry_key is None for _, _, retry_key in pending_reminders())
+    dispatcher = FakeDispatcher(ok=True)
+    run_at(monkeypatch, datetime.datetime(2025, 2, 4, 12, 0, tzinfo=JST), dispatcher)
+    assert len(dispatcher.calls) == 1
+    assert dispatcher.calls[0][1] is not None
+
+
+def test_expired_retry_keys_are_not_reused(monkeypatch):
+    registered = datetime.datetime(2025, 1, 1, 10, 0, tzinfo=JST)
+    utils.update_user_state("U1", 2, "R001", None, registered)
+    first_run = datetime.datetime(2025, 1, 4, 12, 0, tzinfo=JST)
+    run_at(monkeypatch, first_run, FakeDispatcher(ok=False))
+
+    # キーを割り当ててから 23 時間以内なら同じキーで送り直し、過ぎたら送らない
+    later = first_run + datetime.timedelta(hours=22)
+    assert len(send_reminders.prepare_due_reminders(later, max_age_days=0)) == 1
+    later = first_run + datetime.timedelta(hours=25)
+    assert send_reminders.prepare_due_reminders(later, max_age_days=0) == []
+    assert len(pending_reminders()) == len(utils.REMINDER_OFFSETS)
+
+
+def test_catch_up_only_resends_the_last_scheduled_run(monkeypatch):
+    # 3 日後のリマインダーは 1 月 4 日 10 時、15 時に登録した U2 は 1 月 4 日 15 時が期限
+    utils.update_user_states(
+        [
+            ("U1", 2, "R001", None, datetime.datetime(2025, 1, 1, 10, 0, tzinfo=JST)),
+            ("U2", 2, "R002", None, datetime.datetime(2025, 1, 1, 15, 0, tzinfo=JST)),
+        ]
+    )
+    dispatcher = FakeDispatcher(ok=True)
+    now = datetime.datetime(2025, 1, 4, 16, 0, tzinfo=JST)
+
+    class FrozenDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now
+
+    monkeypatch.setattr(
+        send_reminders,
+        "datetime",
+        types.SimpleNamespace(datetime=FrozenDatetime, timedelta=datetime.timedelta),
+    )
+    assert asyncio.run(send_reminders.check_reminders_async(dispatcher, catch_up=True))
+    # 12 時の送信ジョブより後に期限が来た U2 は、次の送信ジョブで送る
+    assert [user_ids for user_ids, _ in dispatcher.calls] == [["U1"]]
+
+
+def test_failed_run_and_new_leader_schedule_a_catch_up(monkeypatch):
+    from src import rule
+
+    scheduled = []
+    monkeypatch.setattr(rule, "schedule_reminder_catch_up", scheduled.append)
+
+    async def failing_check(catch_up=False):
+        return False
+
+    monkeypatch.setattr(rule, "check_reminders_async", failing_check)
+    monkeypatch.setattr(
+        rule, "scheduler_leader", types.SimpleNamespace(is_leader=True)
+    )
+    asyncio.run(rule.check_reminders_if_leader())
+    assert scheduled == [rule.REMINDER_CATCH_UP_DELAY]
+
+    # リーダーになったプロセスは、すぐに直近の送信ジョブの分を確認する
+    monkeypatch.setattr(
+        rule,
+        "scheduler_leader",
+        types.SimpleNamespace(is_leader=False, try_acquire=lambda: True),
+    )
+    rule.elect_scheduler_leader()
+    assert scheduled == [rule.REMINDER_CATCH_UP_DELAY, 0]
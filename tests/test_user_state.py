@@ -0,0 +1,174 @@
+import datetime
+import random
+
+from src import utils
+
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+REMINDER_COLUMNS = [kind for kind, _ in utils.REMINDER_OFFSETS]
+
+
+def fetch_row(user_id):
+    return utils.get_connection().execute(
+        "SELECT research_id, step, last_question, registration_time, "
+        + ", ".join(REMINDER_COLUMNS)
+        + " FROM user_state WHERE user_id=?",
+        (user_id,),
+    ).fetchone()
+
+
+def registered_at(day):
+    return datetime.datetime(2025, 1, day, 10, 30, tzinfo=JST)
+
+
+def expected_reminders(registration_time):
+    return tuple(
+        str(registration_time + datetime.timedelta(days=days))
+        for _, days in utils.REMINDER_OFFSETS
+    )
+
+
+def test_insert_sets_all_columns():
+    utils.update_user_state("U1", 1, None, None, registered_at(1))
+
+    research_id, step, last_question, registration_time, *reminders = fetch_row("U1")
+    assert (research_id, step, last_question) == (None, 1, None)
+    assert registration_time == str(registered_at(1))
+    assert tuple(reminders) == expected_reminders(registered_at(1))
+
+
+def test_research_id_is_set_when_none_stored():
+    utils.update_user_state("U1", 1, None, None, registered_at(1))
+    utils.update_user_state("U1", 2, "R001", None, registered_at(1))
+
+    assert fetch_row("U1")[:2] == ("R001", 2)
+
+
+def test_research_id_is_kept_unless_step_is_1():
+    utils.update_user_state("U1", 2, "R001")
+    utils.update_user_state("U1", 3, "R002")
+    assert fetch_row("U1")[0] == "R001"
+
+    # None を渡しても消えない
+    utils.update_user_state("U1", 4)
+    assert fetch_row("U1")[0] == "R001"
+
+    # step 1（再登録）のときだけ渡した値で置き換わる（None なら消える）
+    utils.update_user_state("U1", 1, None)
+    assert fetch_row("U1")[0] is None
+    utils.update_user_state("U1", 1, "R003")
+    assert fetch_row("U1")[0] == "R003"
+
+
+def test_registration_and_reminders_are_kept_without_registration_time():
+    utils.update_user_state("U1", 2, "R001", None, registered_at(1))
+    before = fetch_row("U1")[3:]
+
+    utils.update_user_state("U1", 3)
+    utils.update_user_state("U1", 4, None, "質問")
+
+    row = fetch_row("U1")
+    assert row[1:3] == (4, "質問")
+    assert row[3:] == before
+
+
+def test_registration_time_replaces_reminders():
+    utils.update_user_state("U1", 2, "R001", None, registered_at(1))
+    utils.update_user_state("U1", 1, None, None, registered_at(5))
+
+    _, _, _, registration_time, *reminders = fetch_row("U1")
+    assert registration_time == str(registered_at(5))
+    assert tuple(reminders) == expected_reminders(registered_at(5))
+
+
+def test_insert_without_registration_time_leaves_reminders_empty():
+    utils.update_user_state("U1", 3, "R001")
+
+    assert fetch_row("U1")[4:] == (None,) * len(REMINDER_COLUMNS)
+
+
+def test_bulk_update_matches_single_updates():
+    updates = [
+        ("U1", 2, "R001", None, registered_at(1)),
+        ("U2", 2, "R002", None, registered_at(2)),
+        ("U1", 10),
+        ("U2", 1, "R009", None, None),
+        ("U3", 5, "R003"),
+    ]
+    utils.update_user_states(updates)
+    bulk = {user_id: fetch_row(user_id) for user_id in ("U1", "U2", "U3")}
+
+    utils.get_connection().execute("DELETE FROM user_state")
+    utils.get_connection().commit()
+    for update in updates:
+        utils.update_user_state(*update)
+
+    assert {user_id: fetch_row(user_id) for user_id in bulk} == bulk
+    assert bulk["U1"][:2] == ("R001", 10)
+    assert bulk["U1"][3] == str(registered_at(1))
+    assert bulk["U2"][:2] == ("R009", 1)
+    assert bulk["U2"][3] == str(registered_at(2))
+
+
+def test_bulk_update_registers_reminders():
+    utils.update_user_states(
+        [("U1", 2, "R001", None, registered_at(1)), ("U2", 10)]
+    )
+
+    rows = utils.get_connection().execute(
+        "SELECT user_id, kind, due_at, sent_at FROM reminders ORDER BY kind"
+    ).fetchall()
+    assert {user_id for user_id, *_ in rows} == {"U1"}
+    assert len(rows) == len(utils.REMINDER_OFFSETS)
+    assert all(sent_at is None for *_, sent_at in rows)
+
+
+def reference_update(rows, user_id, step, research_id=None, last_question=None, registration_time=None):
+    """変更前の update_user_state（SELECT してから UPDATE / INSERT）と同じ規則"""
+    existing = rows.get(user_id)
+    if existing is not None and step != 1:
+        if not (existing["research_id"] is None and research_id is not None):
+            research_id = existing["research_id"]
+    row = {"research_id": research_id, "step": step, "last_question": last_question}
+    if registration_time is not None:
+        row["registration_time"] = str(registration_time)
+        row["reminders"] = expected_reminders(registration_time)
+    elif existing is not None:
+        row["registration_time"] = existing["registration_time"]
+        row["reminders"] = existing["reminders"]
+    else:
+        # 変更前は registration_time が一度も渡されていないと例外になっていた（今は空のまま登録する）
+        row["registration_time"] = None
+        row["reminders"] = (None,) * len(REMINDER_COLUMNS)
+    rows[user_id] = row
+
+
+def test_random_updates_match_reference():
+    rng = random.Random(0)
+    rows = {}
+    for _ in range(500):
+        update = (
+            rng.choice(["U1", "U2", "U3"]),
+            rng.choice([1, 2, 3, 5, 10]),
+            rng.choice([None, "R001", "R002"]),
+            rng.choice([None, "質問"]),
+            rng.choice([None, None, registered_at(rng.randint(1, 28))]),
+        )
+        reference_update(rows, *update)
+        utils.update_user_state(*update)
+
+        user_id = update[0]
+        expected = rows[user_id]
+        assert fetch_row(user_id) == (
+            expected["research_id"],
+            expected["step"],
+            expected["last_question"],
+            expected["registration_time"],
+            *expected["reminders"],
+        )
+        # キャッシュから返す値も DB と一致する
+        assert utils.get_user_state(user_id) == (
+            expected["step"],
+            expected["research_id"],
+            expected["last_question"],
+        )
@@ -0,0 +1,59 @@
+import numpy as np
+
+from src.vector_index import BruteForceIndex, IvfIndex
+
+
+def normalized(rng, n, dim=32):
+    vectors = rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_ivf_reads_vectors_from_the_shared_array(tmp_path):
+    rng = np.random.default_rng(0)
+    np.save(tmp_path / "vectors.npy", normalized(rng, 2000))
+    vectors = np.load(tmp_path / "vectors.npy", mmap_mode="r")
+
+    index = IvfIndex(vectors, nlist=16)
+
+    # mmap の配列をコピーせず、クラスタには行番号だけを持つ
+    assert np.shares_memory(index.vectors, vectors)
+    assert sum(len(rows) for rows in index.list_rows) == len(vectors)
+
+
+def test_ivf_with_all_lists_matches_brute_force_after_add_and_remove():
+    rng = np.random.default_rng(0)
+    vectors = normalized(rng, 500)
+    added = normalized(rng, 20)
+    queries = np.vstack([normalized(rng, 30), added[:5]])
+
+    ivf = IvfIndex(vectors, nlist=8, nprobe=8)
+    brute = BruteForceIndex(vectors)
+    for index in (ivf, brute):
+        index.add(np.arange(500, 520), added)
+        index.remove([0, 1, 505])
+    # 既存の ID に add すると置き換わる
+    ivf.add([7], added[:1])
+    brute.remove([7])
+    brute.add([7], added[:1])
+
+    ivf_ids, ivf_scores = ivf.search(queries, 5)
+    brute_ids, brute_scores = brute.search(queries, 5)
+    assert len(ivf) == len(brute)
+    np.testing.assert_array_equal(ivf_ids, brute_ids)
+    np.testing.assert_allclose(ivf_scores, brute_scores, rtol=1e-5)
+
+
+def test_both_backends_return_at_most_the_index_size():
+    rng = np.random.default_rng(0)
+    vectors = normalized(rng, 3)
+    queries = normalized(rng, 4)
+
+    indexes = (BruteForceIndex(vectors), IvfIndex(vectors, nlist=2))
+    results = [index.search(queries, 5) for index in indexes]
+
+    # 件数より大きい k でも -1 で埋めず、どちらも件数までの列を返す
+    for ids, scores in results:
+        assert ids.shape == scores.shape == (4, 3)
+        assert (ids >= 0).all()
+    np.testing.assert_array_equal(results[0][0], results[1][0])
+    np.testing.assert_allclose(results[0][1], results[1][1], rtol=1e-5)